@@ -0,0 +1,128 @@
+"""Measures DataIO save and load performance for each save mode
+
+Run from Red's folder:
+    python benchmarks/dataio.py
+    python benchmarks/dataio.py --sizes 1K 1M --modes compact safe
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cogs.utils.dataIO import dataIO, MODES
+
+
+DEFAULT_SIZES = ("1K", "10K", "100K", "1M", "10M", "100M")
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.upper().rstrip("B")
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return "{:.0f}{}".format(n, unit) if unit == "B" else \
+                   "{:.1f}{}".format(n, unit)
+        n /= 1024
+
+
+def synthetic_data(target_size):
+    """Builds a bank-like document of roughly target_size bytes once saved
+    in the safe mode"""
+    def account(n):
+        return {"name": "User {}".format(n),
+                "balance": n * 26,
+                "created_at": "2017-01-01 00:00:00"}
+
+    sample = json.dumps({"100000000000000000": account(0)}, indent=4,
+                        sort_keys=True, separators=(',', ' : '))
+    per_entry = len(sample) + 8  # One level deeper in the real document
+    servers = max(1, target_size // (per_entry * 100))
+    per_server = max(1, target_size // (per_entry * servers))
+    data = {}
+    n = 0
+    for s in range(servers):
+        server = {}
+        for _ in range(per_server):
+            server[str(100000000000000000 + n)] = account(n)
+            n += 1
+        data[str(200000000000000000 + s)] = server
+    return data
+
+
+def repetitions_for(size):
+    return max(3, min(50, (10 * UNITS["M"]) // max(size, 1)))
+
+
+def bench(path, data, mode, reps):
+    dataIO.set_mode(path, mode)
+    saves = []
+    loads = []
+    for _ in range(reps):
+        start = time.perf_counter()
+        if not dataIO.save_json(path, data):
+            raise RuntimeError("Save failed in mode {}".format(mode))
+        saves.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        dataIO.load_json(path)
+        loads.append(time.perf_counter() - start)
+    return saves, loads, os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DataIO benchmark")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES,
+                        help="Approximate sizes of the synthetic files "
+                             "(e.g. 1K 10M)")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--repetitions", type=int, default=None,
+                        help="Saves/loads per size and mode. Scaled on the "
+                             "file size by default")
+    parser.add_argument("--dir", default=None,
+                        help="Folder to write the files in. Use one on the "
+                             "same disk as Red's data folder for meaningful "
+                             "results. Defaults to a temporary folder")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="red-dataio-")
+    header = ("{:>8} {:>9} {:>9} {:>11} {:>11} {:>11} {:>11} {:>10}"
+              "".format("size", "mode", "on disk", "save p50", "save max",
+                        "load p50", "load max", "save MB/s"))
+    print(header)
+    print("-" * len(header))
+    try:
+        for size in args.sizes:
+            target = parse_size(size)
+            data = synthetic_data(target)
+            reps = args.repetitions or repetitions_for(target)
+            for mode in args.modes:
+                path = os.path.join(directory, "bench-{}.json".format(mode))
+                saves, loads, on_disk = bench(path, data, mode, reps)
+                save_p50 = statistics.median(saves)
+                print("{:>8} {:>9} {:>9} {:>9.2f}ms {:>9.2f}ms {:>9.2f}ms "
+                      "{:>9.2f}ms {:>10.1f}"
+                      "".format(size, mode, format_size(on_disk),
+                                save_p50 * 1000, max(saves) * 1000,
+                                statistics.median(loads) * 1000,
+                                max(loads) * 1000,
+                                on_disk / UNITS["M"] / save_p50))
+                os.remove(path)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
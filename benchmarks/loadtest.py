@@ -0,0 +1,556 @@
+"""Replays a message stream through Red without connecting to Discord
+
+The bot is built by red.initialize() and runs its real event handlers, but
+its servers, channels, members and roles are synthetic and every call to
+Discord's API is captured and answered after a simulated latency.
+
+Run from Red's folder:
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --cogs alias customcom mod --rate 500
+    python benchmarks/loadtest.py --replay stream.jsonl --latency 0.1
+
+Streams are JSON lines like {"server": "1", "channel": "2", "author": "3",
+"content": "!help"}. --save-stream writes the generated one to a file so
+that runs can be repeated and compared.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import datetime
+import tempfile
+import statistics
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "lib"))
+
+import discord
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+DEFAULT_COGS = ("alias", "customcom", "general", "mod", "economy", "trivia")
+OWNER_ID = "900000000000000000"
+BOT_ID = "900000000000000001"
+
+# Commands that would try to reach the outside world, stop the bot or wait
+# for an answer that never comes
+EXCLUDED_COMMANDS = {"shutdown", "restart", "set", "load", "unload", "reload",
+                     "debug", "join", "leave", "servers", "contact", "pip",
+                     "cog", "traceback", "play", "yt", "stream", "twitch",
+                     "hitbox", "mixer", "picarto", "image", "imgur", "gif",
+                     "gifr", "urban", "lmgtfy", "stats", "version", "fav",
+                     "addfav"}
+
+
+class Fake:
+    """Base of the synthetic Discord objects"""
+    spec = None  # Name of the discord.py class being stood in for
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    def __eq__(self, other):
+        return isinstance(other, Fake) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def __class__(self):
+        # Makes isinstance checks against discord.py's classes pass
+        return getattr(discord, self.spec or "", type(self))
+
+    @property
+    def mention(self):
+        return "<@{}>".format(self.id)
+
+
+class FakePermissions:
+    def __getattr__(self, name):
+        return True
+
+
+class FakeRole(Fake):
+    spec = "Role"
+
+    def __init__(self, id, name, position):
+        super().__init__(id, name)
+        self.position = position
+        self.permissions = FakePermissions()
+        self.is_everyone = position == 0
+
+
+class FakeMember(Fake):
+    spec = "Member"
+
+    def __init__(self, id, name, server=None, roles=(), bot=False):
+        super().__init__(id, name)
+        self.server = server
+        self.roles = list(roles)
+        self.bot = bot
+        self.nick = None
+        self.display_name = name
+        self.discriminator = "0001"
+        self.avatar_url = ""
+        self.default_avatar_url = ""
+        self.created_at = datetime.datetime(2017, 1, 1)
+        self.joined_at = self.created_at
+        self.voice_channel = None
+        self.server_permissions = FakePermissions()
+        self.game = None
+        self.status = "online"
+        self.colour = self.color = 0
+
+    @property
+    def top_role(self):
+        return max(self.roles, key=lambda r: r.position)
+
+    def permissions_in(self, channel):
+        return FakePermissions()
+
+
+class FakeChannel(Fake):
+    spec = "Channel"
+
+    def __init__(self, id, name, server):
+        super().__init__(id, name)
+        self.server = server
+        self.is_private = False
+        self.is_default = False
+        self.type = "text"
+        self.topic = None
+        self.position = 0
+        self.changed_roles = []
+
+    @property
+    def mention(self):
+        return "<#{}>".format(self.id)
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+
+class FakeServer(Fake):
+    spec = "Server"
+
+    def __init__(self, id, name):
+        super().__init__(id, name)
+        self.roles = [FakeRole(id, "@everyone", 0)]
+        self.default_role = self.roles[0]
+        self.channels = []
+        self._channels = {}
+        self._members = {}
+        self.me = None
+        self.owner = None
+        self.large = False
+        self.unavailable = False
+        self.icon_url = ""
+        self.region = "eu-central"
+        self.created_at = datetime.datetime(2017, 1, 1)
+
+    @property
+    def members(self):
+        return self._members.values()
+
+    @property
+    def member_count(self):
+        return len(self._members)
+
+    def get_member(self, id):
+        return self._members.get(id)
+
+    def get_channel(self, id):
+        return self._channels.get(id)
+
+    def get_member_named(self, name):
+        for member in self._members.values():
+            if member.name == name:
+                return member
+
+
+class FakeMessage(Fake):
+    spec = "Message"
+
+    def __init__(self, id, content, author, channel):
+        super().__init__(id, content)
+        self.content = content
+        self.clean_content = content
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+        self.timestamp = datetime.datetime.utcnow()
+        self.edited_timestamp = None
+        self.tts = False
+        self.pinned = False
+        self.embeds = []
+        self.attachments = []
+        self.mentions = []
+        self.channel_mentions = []
+        self.role_mentions = []
+        self.mention_everyone = False
+        self.reactions = []
+        self.type = None
+
+
+class World:
+    """Synthetic servers with their channels, members and roles"""
+
+    def __init__(self, servers, channels, members, seed):
+        self.random = random.Random(seed)
+        self.servers = []
+        self.bot_user = FakeMember(BOT_ID, "Red", bot=True)
+        n = 100000000000000000
+        for s in range(servers):
+            server = FakeServer(str(n + s * 10000), "Server {}".format(s))
+            admin = FakeRole(server.id + "1", "Transistor", 2)
+            mod = FakeRole(server.id + "2", "Process", 1)
+            server.roles += [mod, admin]
+            for c in range(channels):
+                channel = FakeChannel(str(int(server.id) + 100 + c),
+                                      "channel-{}".format(c), server)
+                server.channels.append(channel)
+                server._channels[channel.id] = channel
+            for m in range(members):
+                roles = [server.default_role]
+                if m == 0:
+                    roles.append(admin)
+                elif m < 3:
+                    roles.append(mod)
+                member = FakeMember(str(int(server.id) + 1000 + m),
+                                    "user{}".format(m), server, roles)
+                server._members[member.id] = member
+            server.owner = server.get_member(str(int(server.id) + 1000))
+            server.me = FakeMember(BOT_ID, "Red", server,
+                                   [server.default_role], bot=True)
+            server._members[BOT_ID] = server.me
+            self.servers.append(server)
+        self._by_id = {s.id: s for s in self.servers}
+        self._message_id = 200000000000000000
+
+    def message(self, entry):
+        server = self._by_id[entry["server"]]
+        channel = server.get_channel(entry["channel"])
+        author = server.get_member(entry["author"])
+        self._message_id += 1
+        return FakeMessage(str(self._message_id), entry["content"], author,
+                           channel)
+
+    def generate(self, count, prefix, commands, routes, command_ratio):
+        """Yields stream entries: mostly chatter, some commands"""
+        words = ("lol", "hello", "anyone", "here", "the", "game", "tonight",
+                 "what", "is", "this", "nice", "gg", "ok", "https://x.y/z")
+        humans = {s.id: [m for m in s.members if not m.bot]
+                  for s in self.servers}
+        for _ in range(count):
+            server = self.random.choice(self.servers)
+            channel = self.random.choice(server.channels)
+            author = self.random.choice(humans[server.id])
+            roll = self.random.random()
+            if roll < command_ratio and commands:
+                content = prefix + self.random.choice(commands)
+            elif roll < command_ratio * 2 and routes:
+                content = prefix + self.random.choice(routes)
+            else:
+                content = " ".join(self.random.choice(words) for _ in
+                                   range(self.random.randint(1, 12)))
+            yield {"server": server.id, "channel": channel.id,
+                   "author": author.id, "content": content}
+
+
+class Outbound:
+    """Answers the bot's API calls after a simulated latency"""
+
+    def __init__(self, world, latency, jitter):
+        self.world = world
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._message_id = 300000000000000000
+
+    async def wait(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0, self.latency + random.uniform(
+                -self.jitter, self.jitter)))
+
+    async def send_message(self, destination, content=None, *, tts=False,
+                           embed=None):
+        self.calls["send_message"] += 1
+        await self.wait()
+        channel = destination
+        if not isinstance(destination, FakeChannel):  # A user: DM
+            channel = FakeChannel(destination.id, "dm", None)
+            channel.is_private = True
+        self._message_id += 1
+        return FakeMessage(str(self._message_id), str(content or ""),
+                           self.world.bot_user, channel)
+
+    def method(self, name):
+        async def call(*args, **kwargs):
+            self.calls[name] += 1
+            await self.wait()
+            if name == "edit_message" and args:
+                return args[0]
+        return call
+
+    async def request(self, route, **kwargs):
+        self.calls["http " + getattr(route, "path", str(route))] += 1
+        await self.wait()
+        return {}
+
+
+API_METHODS = ("edit_message", "delete_message", "delete_messages",
+               "add_reaction", "remove_reaction", "clear_reactions",
+               "send_typing", "send_file", "change_presence", "add_roles",
+               "remove_roles", "replace_roles", "change_nickname", "ban",
+               "unban", "kick", "edit_channel_permissions",
+               "delete_channel_permissions", "pin_message", "unpin_message",
+               "start_private_message", "get_message", "pins_from",
+               "logs_from", "create_channel", "edit_role", "create_role")
+
+
+def build_bot(args, world, outbound):
+    sys.argv = [sys.argv[0], "--no-prompt", "--memory-only", "--owner",
+                OWNER_ID, "--prefix", args.prefix] + args.red_args
+    import red
+    from cogs.utils.dataIO import dataIO
+
+    bot = red.initialize()
+    bot.connection.user = world.bot_user
+    for server in world.servers:
+        bot.connection._servers[server.id] = server
+
+    bot.outbox._send = outbound.send_message
+    for name in API_METHODS:
+        setattr(bot, name, outbound.method(name))
+    bot.http.request = outbound.request
+    bot._count_api_requests()
+
+    errors = Counter()
+
+    async def on_error(event, *args, **kwargs):
+        errors[sys.exc_info()[0].__name__] += 1
+    bot.on_error = on_error
+
+    bot.load_extension("cogs.owner")
+    for cog in args.cogs:
+        try:
+            bot.load_extension("cogs." + cog)
+        except Exception as e:
+            print("Couldn't load {}: {}: {}".format(cog, type(e).__name__, e))
+    return bot, dataIO, errors
+
+
+def seed_routes(bot, world, amount):
+    """Adds amount custom commands and aliases to every server"""
+    names = []
+    customcom = bot.get_cog("CustomCommands")
+    alias = bot.get_cog("Alias")
+    for server in world.servers:
+        if customcom is not None:
+            commands = {}
+            for n in range(amount):
+                commands["cc{}".format(n)] = "Custom command {}".format(n)
+                bot.add_route("cc{}".format(n), customcom.run_command,
+                              server=server.id)
+            customcom.c_commands[server.id] = commands
+        if alias is not None:
+            alias.aliases[server.id] = {"al{}".format(n): "ping"
+                                        for n in range(amount)}
+            for n in range(amount):
+                bot.add_route("al{}".format(n), alias.run_alias,
+                              server=server.id)
+    if customcom is not None:
+        names += ["cc{}".format(n) for n in range(amount)]
+    if alias is not None:
+        names += ["al{}".format(n) for n in range(amount)]
+    return names
+
+
+async def handle(bot, message):
+    # What Client.dispatch("message", message) would schedule
+    coros = [bot._run_event("on_message", message)]
+    for listener in bot.extra_events.get("on_message", []):
+        coros.append(bot._run_extra(listener, "message", message))
+    start = time.perf_counter()
+    await asyncio.gather(*coros)
+    return time.perf_counter() - start
+
+
+async def replay(bot, world, stream, rate, concurrency):
+    latencies = []
+
+    async def one(entry):
+        latencies.append(await handle(bot, world.message(entry)))
+
+    start = time.perf_counter()
+    if rate:
+        # Open loop: messages arrive on schedule, however slow Red is
+        tasks = []
+        for n, entry in enumerate(stream):
+            delay = start + n / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(one(entry)))
+        await asyncio.gather(*tasks)
+    else:
+        # Closed loop: as fast as concurrency allows
+        stream = iter(stream)
+
+        async def worker():
+            for entry in stream:
+                await one(entry)
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+def max_rss_mb():
+    if resource is None:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(args, bot, latencies, elapsed, outbound, errors, rss_before):
+    from cogs.utils.metrics import metrics
+
+    print("Cogs: {}".format(", ".join(sorted(bot.cogs))))
+    print("{} messages in {:.2f}s: {:.0f} messages/s".format(
+        len(latencies), elapsed, len(latencies) / elapsed))
+    print("Handler latency: p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms".format(
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        max(latencies or [0]) * 1000))
+    if latencies:
+        print("Mean latency: {:.2f}ms".format(
+            statistics.mean(latencies) * 1000))
+    print("Max RSS: {:.1f}MB ({:+.1f}MB during the run)".format(
+        max_rss_mb(), max_rss_mb() - rss_before))
+    print("API calls: {}".format(", ".join(
+        "{} {}".format(n, name) for name, n in outbound.calls.most_common(8))
+        or "none"))
+    if errors:
+        print("Handler errors: {}".format(", ".join(
+            "{} {}".format(n, name) for name, n in errors.most_common())))
+
+    for name, label in (("red_listener_seconds", "listener"),
+                        ("red_command_seconds", "command")):
+        top = metrics.top(name, args.top)
+        if not top:
+            continue
+        print()
+        header = "{:<34} {:>8} {:>10} {:>10} {:>10}".format(
+            label, "calls", "total s", "p50 ms", "p99 ms")
+        print(header)
+        print("-" * len(header))
+        for labels, h in top:
+            print("{:<34} {:>8} {:>10.3f} {:>10.2f} {:>10.2f}".format(
+                labels[label][:34], h.count, h.sum, h.quantile(0.5) * 1000,
+                h.quantile(0.99) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Red offline load test")
+    parser.add_argument("--cogs", nargs="*", default=DEFAULT_COGS,
+                        help="Cogs to load besides owner")
+    parser.add_argument("--messages", type=int, default=10000,
+                        help="Messages to generate")
+    parser.add_argument("--replay", default=None,
+                        help="JSON lines file with the stream to replay "
+                             "instead of a generated one")
+    parser.add_argument("--save-stream", default=None,
+                        help="Writes the generated stream to this file")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Messages per second. 0 (default) sends them "
+                             "as fast as Red handles them")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Messages in flight when --rate is 0")
+    parser.add_argument("--servers", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=5,
+                        help="Channels per server")
+    parser.add_argument("--members", type=int, default=50,
+                        help="Members per server")
+    parser.add_argument("--routes", type=int, default=20,
+                        help="Custom commands and aliases added to every "
+                             "server if their cogs are loaded. Use the "
+                             "value the replayed stream was saved with")
+    parser.add_argument("--command-ratio", type=float, default=0.1,
+                        help="Share of generated messages invoking a "
+                             "command. The same share invokes a custom "
+                             "command or alias")
+    parser.add_argument("--prefix", default="!")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds taken by each simulated API call")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=26)
+    parser.add_argument("--top", type=int, default=10,
+                        help="Slowest listeners and commands to show")
+    parser.add_argument("--data-dir", default=None,
+                        help="Folder used as Red's data folder. Defaults to "
+                             "a temporary one")
+    parser.add_argument("--red-args", nargs=argparse.REMAINDER, default=[],
+                        help="Arguments passed on to Red, e.g. "
+                             "--red-args --save-mode compact")
+    args = parser.parse_args()
+
+    directory = args.data_dir or tempfile.mkdtemp(prefix="red-loadtest-")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    rss_before = max_rss_mb()
+    try:
+        world = World(args.servers, args.channels, args.members, args.seed)
+        outbound = Outbound(world, args.latency, args.jitter)
+        bot, dataIO, errors = build_bot(args, world, outbound)
+        loop = asyncio.get_event_loop()
+
+        # A replayed stream invokes the routes too, given the same --routes
+        routes = seed_routes(bot, world, args.routes)
+        if args.replay:
+            with open(os.path.join(cwd, args.replay), encoding="utf-8") as f:
+                stream = [json.loads(line) for line in f if line.strip()]
+        else:
+            commands = sorted(name for name, cmd in bot.commands.items()
+                              if name not in EXCLUDED_COMMANDS and
+                              not cmd.hidden)
+            stream = list(world.generate(args.messages, args.prefix,
+                                         commands, routes,
+                                         args.command_ratio))
+            if args.save_stream:
+                path = os.path.join(cwd, args.save_stream)
+                with open(path, encoding="utf-8", mode="w") as f:
+                    for entry in stream:
+                        f.write(json.dumps(entry) + "\n")
+
+        latencies, elapsed = loop.run_until_complete(
+            replay(bot, world, stream, args.rate, args.concurrency))
+        loop.run_until_complete(dataIO.join())
+        dataIO.flush()
+        report(args, bot, latencies, elapsed, outbound, errors, rss_before)
+    finally:
+        os.chdir(cwd)
+        if args.data_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,28 @@
 from discord.ext import commands
 from .utils.chat_formatting import box
 from .utils.dataIO import dataIO
+from .utils.storage import open_storage
 from .utils import checks
-from __main__ import user_allowed, send_cmd_help
+from __main__ import send_cmd_help
 from copy import copy
 import os
 import discord
 
 
 class Alias:
+    __routes__ = True  # Added from the data, see Owner._save_manifest
+
     def __init__(self, bot):
         self.bot = bot
         self.file_path = "data/alias/aliases.json"
-        self.aliases = dataIO.load_json(self.file_path)
+        self.aliases = open_storage(self.file_path)
         self.remove_old()
+        for sid, server_aliases in self.aliases.items():
+            for alias in server_aliases:
+                bot.add_route(alias, self.run_alias, server=sid)
+
+    def __unload(self):
+        self.aliases.close()
 
     @commands.group(pass_context=True, no_pm=True)
     async def alias(self, ctx):
@@ -41,11 +50,11 @@ class Alias:
         prefix = self.get_prefix(server, to_execute)
         if prefix is not None:
             to_execute = to_execute[len(prefix):]
-        if server.id not in self.aliases:
-            self.aliases[server.id] = {}
         if command not in self.bot.commands:
-            self.aliases[server.id][command] = to_execute
-            dataIO.save_json(self.file_path, self.aliases)
+            server_aliases = self.aliases.get(server.id, {})
+            server_aliases[command] = to_execute
+            self.aliases[server.id] = server_aliases
+            self.bot.add_route(command, self.run_alias, server=server)
             await self.bot.say("Alias '{}' added.".format(command))
         else:
             await self.bot.say("Cannot add '{}' because it's a real bot "
@@ -88,7 +97,8 @@ class Alias:
         server = ctx.message.server
         if server.id in self.aliases:
             self.aliases[server.id].pop(command, None)
-            dataIO.save_json(self.file_path, self.aliases)
+            self.aliases.save(server.id)
+            self.bot.remove_route(command, self.run_alias, server=server)
         await self.bot.say("Alias '{}' deleted.".format(command))
 
     @alias.command(name="list", pass_context=True, no_pm=True)
@@ -110,25 +120,15 @@ class Alias:
             else:
                 await self.bot.say("There are no aliases on this server.")
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
-            return
-
-        msg = message.content
-        server = message.server
-        prefix = self.get_prefix(server, msg)
-
-        if not prefix:
-            return
-
-        if server.id in self.aliases and user_allowed(message):
-            alias = self.first_word(msg[len(prefix):]).lower()
-            if alias in self.aliases[server.id]:
-                new_command = self.aliases[server.id][alias]
-                args = message.content[len(prefix + alias):]
-                new_message = copy(message)
-                new_message.content = prefix + new_command + args
-                await self.bot.process_commands(new_message)
+    async def run_alias(self, parsed):
+        message = parsed.message
+        server_aliases = self.aliases.get(message.server.id, {})
+        alias = parsed.invoked.lower()
+        if alias in server_aliases:
+            new_message = copy(message)
+            new_message.content = (parsed.prefix + server_aliases[alias] +
+                                   parsed.args)
+            await self.bot.process_commands(new_message)
 
     def part_of_existing_command(self, alias, server):
         '''Command or alias'''
@@ -141,6 +141,7 @@ class Alias:
         for sid in self.aliases:
             to_delete = []
             to_add = []
+            fixed = False
             for aliasname, alias in self.aliases[sid].items():
                 lower = aliasname.lower()
                 if aliasname != lower:
@@ -153,21 +154,19 @@ class Alias:
                 prefix = self.get_prefix(server, alias)
                 if prefix is not None:
                     self.aliases[sid][aliasname] = alias[len(prefix):]
+                    fixed = True
             for alias in to_delete:  # Fixes caps and bad prefixes
                 del self.aliases[sid][alias]
             for alias, command in to_add:  # For fixing caps
                 self.aliases[sid][alias] = command
-        dataIO.save_json(self.file_path, self.aliases)
+            if to_delete or fixed:
+                self.aliases.save(sid)
 
     def first_word(self, msg):
         return msg.split(" ")[0]
 
     def get_prefix(self, server, msg):
-        prefixes = self.bot.settings.get_prefixes(server)
-        for p in prefixes:
-            if msg.startswith(p):
-                return p
-        return None
+        return self.bot.settings.match_prefix(server, msg)
 
 
 def check_folder():
@@ -4,6 +4,7 @@ import threading
 import os
 from random import shuffle, choice
 from cogs.utils.dataIO import dataIO
+from cogs.utils.migrations import migrations
 from cogs.utils import checks
 from cogs.utils.chat_formatting import pagify, escape
 from urllib.parse import urlparse
@@ -316,9 +317,6 @@ class Audio:
         self.downloaders = {}  # sid: object
         self.settings = dataIO.load_json("data/audio/settings.json")
         self.settings_path = "data/audio/settings.json"
-        self.server_specific_setting_keys = ["VOLUME", "VOTE_ENABLED",
-                                             "VOTE_THRESHOLD", "NOPPL_DISCONNECT",
-                                             "NOTIFY", "NOTIFY_CHANNEL", "TIMER_DISCONNECT"]
         self.cache_path = "data/audio/cache"
         self.local_playlist_path = "data/audio/localtracks"
         self._old_game = False
@@ -2210,34 +2208,10 @@ class Audio:
             sid = server
 
         if sid not in self.settings["SERVERS"]:
+            # Saved along with the first setting changed
             self.settings["SERVERS"][sid] = {}
-        ret = self.settings["SERVERS"][sid]
-
-        # Not the cleanest way. Some refactoring is suggested if more settings
-        # have to be added
-        if "NOPPL_DISCONNECT" not in ret:
-            ret["NOPPL_DISCONNECT"] = True
-
-        if "NOTIFY" not in ret:
-            ret["NOTIFY"] = False
-
-        if "NOTIFY_CHANNEL" not in ret:
-            ret["NOTIFY_CHANNEL"] = None
-
-        if "TIMER_DISCONNECT" not in ret:
-            ret["TIMER_DISCONNECT"] = True
-
-        for setting in self.server_specific_setting_keys:
-            if setting not in ret:
-                # Add the default
-                ret[setting] = self.settings[setting]
-                if setting.lower() == "volume" and ret[setting] <= 1:
-                    ret[setting] *= 100
-        # ^This will make it so that only users with an outdated config will
-        # have their volume set * 100. In theory.
-        self.save_settings()
-
-        return ret
+            fill_server_settings(self.settings, self.settings["SERVERS"][sid])
+        return self.settings["SERVERS"][sid]
 
     def has_connect_perm(self, author, server):
         channel = author.voice_channel
@@ -2423,9 +2397,7 @@ class Audio:
         dataIO.save_json('data/audio/settings.json', self.settings)
 
     def set_server_setting(self, server, key, value):
-        if server.id not in self.settings["SERVERS"]:
-            self.settings["SERVERS"][server.id] = {}
-        self.settings["SERVERS"][server.id][key] = value
+        self.get_server_settings(server)[key] = value
 
     def voice_client(self, server):
         return self.bot.voice_client_in(server)
@@ -2471,6 +2443,42 @@ class Audio:
         for vc in self.bot.voice_clients:
             self.bot.loop.create_task(vc.disconnect())
 
+    def __snapshot__(self):
+        """Queues to resume after a restart. The song being played goes
+        back in front of its queue"""
+        queues = {}
+        for sid, queue in self.queue.items():
+            saved = {"REPEAT": queue[QueueKey.REPEAT],
+                     "PLAYLIST": queue[QueueKey.PLAYLIST],
+                     "VOICE_CHANNEL_ID": queue[QueueKey.VOICE_CHANNEL_ID]}
+            for key in (QueueKey.QUEUE, QueueKey.TEMP_QUEUE):
+                saved[key.name] = [[s.url, s.channel.id] for s in queue[key]
+                                   if s.channel is not None]
+            song = queue[QueueKey.NOW_PLAYING]
+            channel = queue[QueueKey.NOW_PLAYING_CHANNEL]
+            if song is not None and song.webpage_url and channel is not None:
+                key = "TEMP_QUEUE" if saved["TEMP_QUEUE"] else "QUEUE"
+                saved[key].insert(0, [song.webpage_url, channel.id])
+            if saved["QUEUE"] or saved["TEMP_QUEUE"]:
+                queues[sid] = saved
+        return queues
+
+    def __restore__(self, queues):
+        for sid, saved in queues.items():
+            server = self.bot.get_server(sid)
+            if server is None:
+                continue
+            self._setup_queue(server)
+            queue = self.queue[sid]
+            queue[QueueKey.REPEAT] = saved["REPEAT"]
+            queue[QueueKey.PLAYLIST] = saved["PLAYLIST"]
+            queue[QueueKey.VOICE_CHANNEL_ID] = saved["VOICE_CHANNEL_ID"]
+            for key in (QueueKey.QUEUE, QueueKey.TEMP_QUEUE):
+                for url, channel_id in saved[key.name]:
+                    channel = server.get_channel(channel_id)
+                    if channel is not None:
+                        queue[key].append(QueuedSong(url, channel))
+
 
 def check_folders():
     folders = ("data/audio", "data/audio/cache", "data/audio/playlists",
@@ -2508,6 +2516,32 @@ def check_files():
             dataIO.save_json(settings_path, current)
 
 
+def fill_server_settings(settings, server_settings):
+    """Adds the settings missing from a server's ones, mostly taken from
+    the global settings"""
+    # Not the cleanest way. Some refactoring is suggested if more settings
+    # have to be added
+    server_settings.setdefault("NOPPL_DISCONNECT", True)
+    server_settings.setdefault("NOTIFY", False)
+    server_settings.setdefault("NOTIFY_CHANNEL", None)
+    server_settings.setdefault("TIMER_DISCONNECT", True)
+
+    for setting in ("VOLUME", "VOTE_ENABLED", "VOTE_THRESHOLD"):
+        if setting not in server_settings:
+            # Add the default
+            server_settings[setting] = settings[setting]
+            if setting == "VOLUME" and server_settings[setting] <= 1:
+                server_settings[setting] *= 100
+    # ^This will make it so that only users with an outdated config will
+    # have their volume set * 100. In theory.
+
+
+@migrations.register("data/audio/settings.json", 1)
+def _fill_servers_settings(data):
+    for server_settings in data["SERVERS"].values():
+        fill_server_settings(data, server_settings)
+
+
 def verify_ffmpeg_avconv():
     try:
         subprocess.call(["ffmpeg", "-version"], stdout=subprocess.DEVNULL)
@@ -2527,6 +2561,7 @@ def verify_ffmpeg_avconv():
 def setup(bot):
     check_folders()
     check_files()
+    migrations.run("data/audio/settings.json")
 
     if youtube_dl is None:
         raise RuntimeError("You need to run `pip3 install youtube_dl`")
@@ -1,5 +1,6 @@
 from discord.ext import commands
 from .utils.dataIO import dataIO
+from .utils.storage import open_storage
 from .utils import checks
 from .utils.chat_formatting import pagify, box
 import os
@@ -11,10 +12,18 @@ class CustomCommands:
 
     Creates commands used to display text"""
 
+    __routes__ = True  # Added from the data, see Owner._save_manifest
+
     def __init__(self, bot):
         self.bot = bot
         self.file_path = "data/customcom/commands.json"
-        self.c_commands = dataIO.load_json(self.file_path)
+        self.c_commands = open_storage(self.file_path)
+        for sid in self.c_commands:
+            for command in self.c_commands[sid]:
+                bot.add_route(command, self.run_command, server=sid)
+
+    def __unload(self):
+        self.c_commands.close()
 
     @commands.group(aliases=["cc"], pass_context=True, no_pm=True)
     async def customcom(self, ctx):
@@ -44,7 +53,7 @@ class CustomCommands:
         if command not in cmdlist:
             cmdlist[command] = text
             self.c_commands[server.id] = cmdlist
-            dataIO.save_json(self.file_path, self.c_commands)
+            self.bot.add_route(command, self.run_command, server=server)
             await self.bot.say("Custom command successfully added.")
         else:
             await self.bot.say("This command already exists. Use "
@@ -66,7 +75,6 @@ class CustomCommands:
             if command in cmdlist:
                 cmdlist[command] = text
                 self.c_commands[server.id] = cmdlist
-                dataIO.save_json(self.file_path, self.c_commands)
                 await self.bot.say("Custom command successfully edited.")
             else:
                 await self.bot.say("That command doesn't exist. Use "
@@ -91,7 +99,8 @@ class CustomCommands:
             if command in cmdlist:
                 cmdlist.pop(command, None)
                 self.c_commands[server.id] = cmdlist
-                dataIO.save_json(self.file_path, self.c_commands)
+                self.bot.remove_route(command, self.run_command,
+                                      server=server)
                 await self.bot.say("Custom command successfully deleted.")
             else:
                 await self.bot.say("That command doesn't exist.")
@@ -121,33 +130,21 @@ class CustomCommands:
             for page in pagify(commands, delims=[" ", "\n"]):
                 await self.bot.whisper(box(page))
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
-            return
-
-        server = message.server
-        prefix = self.get_prefix(message)
-
-        if not prefix:
+    async def run_command(self, parsed):
+        message = parsed.message
+        if message.server.id not in self.c_commands:
             return
 
-        if server.id in self.c_commands and self.bot.user_allowed(message):
-            cmdlist = self.c_commands[server.id]
-            cmd = message.content[len(prefix):]
-            if cmd in cmdlist:
-                cmd = cmdlist[cmd]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-            elif cmd.lower() in cmdlist:
-                cmd = cmdlist[cmd.lower()]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-
-    def get_prefix(self, message):
-        for p in self.bot.settings.get_prefixes(message.server):
-            if message.content.startswith(p):
-                return p
-        return False
+        cmdlist = self.c_commands[message.server.id]
+        cmd = parsed.invoked + parsed.args
+        if cmd in cmdlist:
+            cmd = cmdlist[cmd]
+            cmd = self.format_cc(cmd, message)
+            await self.bot.send_message(message.channel, cmd)
+        elif cmd.lower() in cmdlist:
+            cmd = cmdlist[cmd.lower()]
+            cmd = self.format_cc(cmd, message)
+            await self.bot.send_message(message.channel, cmd)
 
     def format_cc(self, command, message):
         results = re.findall("\{([^}]+)\}", command)
@@ -1,10 +1,13 @@
 import discord
 from discord.ext import commands
-from cogs.utils.dataIO import dataIO
+from cogs.utils.dataIO import dataIO, LazyShards
+from cogs.utils.journal import Journal
+from cogs.utils.migrations import migrations
 from collections import namedtuple, defaultdict, deque
-from datetime import datetime
+from datetime import datetime, timedelta
 from copy import deepcopy
-from .utils import checks
+from contextlib import contextmanager, ExitStack
+from .utils import checks, logs
 from cogs.utils.chat_formatting import pagify, box
 from enum import Enum
 from __main__ import send_cmd_help
@@ -112,29 +115,38 @@ SLOT_PAYOUTS_MSG = ("Slot machine payouts:\n"
 
 class Bank:
 
-    def __init__(self, bot, file_path):
-        self.accounts = dataIO.load_json(file_path)
+    def __init__(self, bot, path, *, journal_path=None):
+        self.accounts = LazyShards(path)
         self.bot = bot
+        self.path = path
+        self.compact_every = 1000
+        self.journal = None
+        self._dirty_servers = set()
+        if journal_path is not None:
+            self.journal = Journal(journal_path)
+            for record in self.journal.replay():
+                self._dirty_servers.update(self._apply(record))
+            if self.journal:
+                self.compact()
 
     def create_account(self, user, *, initial_balance=0):
-        server = user.server
-        if not self.account_exists(user):
-            if server.id not in self.accounts:
-                self.accounts[server.id] = {}
-            if user.id in self.accounts:  # Legacy account
-                balance = self.accounts[user.id]["balance"]
+        with self._lock(user.server):
+            server = user.server
+            if not self.account_exists(user):
+                if user.id in self.accounts:  # Legacy account
+                    balance = self.accounts[user.id]["balance"]
+                else:
+                    balance = initial_balance
+                timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                account = {"name": user.name,
+                           "balance": balance,
+                           "created_at": timestamp
+                           }
+                self._commit({"op": "create", "server": server.id,
+                              "user": user.id, "account": account})
+                return self.get_account(user)
             else:
-                balance = initial_balance
-            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            account = {"name": user.name,
-                       "balance": balance,
-                       "created_at": timestamp
-                       }
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
-            return self.get_account(user)
-        else:
-            raise AccountAlreadyExists()
+                raise AccountAlreadyExists()
 
     def account_exists(self, user):
         try:
@@ -144,50 +156,54 @@ class Bank:
         return True
 
     def withdraw_credits(self, user, amount):
-        server = user.server
-
         if amount < 0:
             raise NegativeValue()
-
-        account = self._get_account(user)
-        if account["balance"] >= amount:
-            account["balance"] -= amount
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
-        else:
-            raise InsufficientBalance()
+        with self._lock(user.server):
+            account = self._get_account(user)
+            if account["balance"] >= amount:
+                balance = account["balance"] - amount
+                self._commit({"op": "withdraw",
+                              "balances": [self._entry(user, balance)]})
+            else:
+                raise InsufficientBalance()
 
     def deposit_credits(self, user, amount):
-        server = user.server
         if amount < 0:
             raise NegativeValue()
-        account = self._get_account(user)
-        account["balance"] += amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        with self._lock(user.server):
+            account = self._get_account(user)
+            balance = account["balance"] + amount
+            self._commit({"op": "deposit",
+                          "balances": [self._entry(user, balance)]})
 
     def set_credits(self, user, amount):
-        server = user.server
         if amount < 0:
             raise NegativeValue()
-        account = self._get_account(user)
-        account["balance"] = amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        with self._lock(user.server):
+            self._get_account(user)
+            self._commit({"op": "set",
+                          "balances": [self._entry(user, amount)]})
 
     def transfer_credits(self, sender, receiver, amount):
         if amount < 0:
             raise NegativeValue()
         if sender is receiver:
             raise SameSenderAndReceiver()
-        if self.account_exists(sender) and self.account_exists(receiver):
-            sender_acc = self._get_account(sender)
-            if sender_acc["balance"] < amount:
-                raise InsufficientBalance()
-            self.withdraw_credits(sender, amount)
-            self.deposit_credits(receiver, amount)
-        else:
-            raise NoAccount()
+        with self._lock(sender.server, receiver.server):
+            if self.account_exists(sender) and self.account_exists(receiver):
+                sender_acc = self._get_account(sender)
+                if sender_acc["balance"] < amount:
+                    raise InsufficientBalance()
+                receiver_acc = self._get_account(receiver)
+                # Both balances are part of the same record: the transfer
+                # is either replayed in full or not at all
+                balances = [
+                    self._entry(sender, sender_acc["balance"] - amount),
+                    self._entry(receiver, receiver_acc["balance"] + amount)
+                ]
+                self._commit({"op": "transfer", "balances": balances})
+            else:
+                raise NoAccount()
 
     def can_spend(self, user, amount):
         account = self._get_account(user)
@@ -197,8 +213,8 @@ class Bank:
             return False
 
     def wipe_bank(self, server):
-        self.accounts[server.id] = {}
-        self._save_bank()
+        with self._lock(server):
+            self._commit({"op": "wipe", "server": server.id})
 
     def get_server_accounts(self, server):
         if server.id in self.accounts:
@@ -247,8 +263,72 @@ class Bank:
                              "created_at server member")
         return Account(**account)
 
-    def _save_bank(self):
-        dataIO.save_json("data/economy/bank.json", self.accounts)
+    def close(self):
+        """Writes out every pending change"""
+        if self.journal is None:
+            for server_id in self.accounts:
+                dataIO.flush(dataIO.shard_path(self.path, server_id))
+        else:
+            self.compact()
+            self.journal.close()
+
+    def compact(self):
+        """Saves the servers changed since the last compaction and
+        empties the journal"""
+        if self.journal is None:
+            return
+        for server_id in list(self._dirty_servers):
+            accounts = self.accounts[server_id]
+            if not dataIO.save_shard(self.path, server_id, accounts):
+                return
+            self._dirty_servers.discard(server_id)
+        self.journal.truncate()
+
+    def _commit(self, record):
+        servers = self._apply(record)
+        if self.journal is None:
+            for server_id in servers:
+                self._save_bank(server_id)
+            return
+        self._dirty_servers.update(servers)
+        self.journal.append(record)
+        if len(self.journal) >= self.compact_every:
+            self.compact()
+
+    def _apply(self, record):
+        # Records carry the resulting balances rather than the amounts
+        # so replaying them on an already updated snapshot is harmless.
+        # Returns the IDs of the servers whose accounts have changed
+        op = record["op"]
+        if op == "create":
+            server_accounts = self.accounts.setdefault(record["server"], {})
+            server_accounts[record["user"]] = record["account"]
+            return {record["server"]}
+        elif op == "wipe":
+            self.accounts[record["server"]] = {}
+            return {record["server"]}
+        else:
+            servers = set()
+            for server_id, user_id, balance in record["balances"]:
+                self.accounts[server_id][user_id]["balance"] = balance
+                servers.add(server_id)
+            return servers
+
+    @contextmanager
+    def _lock(self, *servers):
+        # Only matters if other processes share the data folder: the
+        # accounts get reloaded if they were changed in the meantime
+        with ExitStack() as stack:
+            for server_id in sorted({s.id for s in servers}):
+                path = dataIO.shard_path(self.path, server_id)
+                stack.enter_context(dataIO.lock(path))
+            yield
+
+    def _entry(self, user, balance):
+        return [user.server.id, user.id, balance]
+
+    def _save_bank(self, server_id):
+        dataIO.mark_shard_dirty(self.path, server_id, self.accounts[server_id])
 
     def _get_account(self, user):
         server = user.server
@@ -286,18 +366,47 @@ class Economy:
     Get rich and have fun with imaginary currency!"""
 
     def __init__(self, bot):
-        global default_settings
         self.bot = bot
-        self.bank = Bank(bot, "data/economy/bank.json")
+        if dataIO.shared:
+            # The journal can't be shared with other processes
+            journal_path = None
+        else:
+            journal_path = "data/economy/bank.journal"
+        self.bank = Bank(bot, "data/economy/bank", journal_path=journal_path)
         self.file_path = "data/economy/settings.json"
         self.settings = dataIO.load_json(self.file_path)
-        if "PAYDAY_TIME" in self.settings:  # old format
-            default_settings = self.settings
-            self.settings = {}
-        self.settings = defaultdict(default_settings.copy, self.settings)
+        # Servers without settings get a copy of the defaults, which can be
+        # the settings from before they were per server
+        defaults = dict(default_settings,
+                        **self.settings.get("DEFAULT", {}))
+        self.settings = defaultdict(defaults.copy, self.settings)
         self.payday_register = defaultdict(dict)
         self.slot_register = defaultdict(dict)
 
+    def __unload(self):
+        self.bank.close()
+
+    def __snapshot__(self):
+        """Payday and slot cooldowns, as UNIX timestamps"""
+        now = time.time()
+        elapsed = time.perf_counter()
+        utcnow = datetime.utcnow()
+        payday = {sid: {uid: now - (elapsed - t) for uid, t in users.items()}
+                  for sid, users in self.payday_register.items()}
+        slot = {uid: now - (utcnow - t).total_seconds()
+                for uid, t in self.slot_register.items()}
+        return {"PAYDAY": payday, "SLOT": slot}
+
+    def __restore__(self, snapshot):
+        now = time.time()
+        elapsed = time.perf_counter()
+        utcnow = datetime.utcnow()
+        for sid, users in snapshot["PAYDAY"].items():
+            for uid, t in users.items():
+                self.payday_register[sid][uid] = int(elapsed - (now - t))
+        for uid, t in snapshot["SLOT"].items():
+            self.slot_register[uid] = utcnow - timedelta(seconds=now - t)
+
     @commands.group(name="bank", pass_context=True)
     async def _bank(self, ctx):
         """Bank operations"""
@@ -709,6 +818,9 @@ def check_folders():
         print("Creating data/economy folder...")
         os.makedirs("data/economy")
 
+    if not os.path.exists("data/economy/bank"):
+        os.makedirs("data/economy/bank")
+
 
 def check_files():
 
@@ -718,15 +830,28 @@ def check_files():
         dataIO.save_json(f, {})
 
     f = "data/economy/bank.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating empty bank.json...")
-        dataIO.save_json(f, {})
+    if dataIO.is_valid_json(f):
+        print("Splitting bank.json into per-server files...")
+        dataIO.migrate_to_shards(f, "data/economy/bank")
+
+
+@migrations.register("data/economy/settings.json", 1)
+def _split_settings(data):
+    # The settings used to be the same for every server. Servers with a
+    # bank get a copy, the others will start from them
+    if "PAYDAY_TIME" not in data:
+        return
+    settings = {sid: dict(data) for sid in LazyShards("data/economy/bank")
+                if sid.isdigit()}
+    settings["DEFAULT"] = data
+    return settings
 
 
 def setup(bot):
     global logger
     check_folders()
     check_files()
+    migrations.run("data/economy/settings.json")
     logger = logging.getLogger("red.economy")
     if logger.level == 0:
         # Prevents the logger from being loaded again in case of module reload
@@ -735,5 +860,5 @@ def setup(bot):
             filename='data/economy/economy.log', encoding='utf-8', mode='a')
         handler.setFormatter(logging.Formatter(
             '%(asctime)s %(message)s', datefmt="[%d/%m/%Y %H:%M]"))
-        logger.addHandler(handler)
+        logs.pipeline.attach(logger, handler)
     bot.add_cog(Economy(bot))
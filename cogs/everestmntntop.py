@@ -1,9 +1,7 @@
 import os
 import random
-import time
 from threading import Timer
 
-from __main__ import user_allowed
 from discord.ext import commands
 
 from .utils import checks
@@ -11,6 +9,7 @@ from .utils.dataIO import dataIO
 
 
 class Everestmntntop:
+    __routes__ = True  # Added from the data, see Owner._save_manifest
     default_cooldown = 5
     config_files = {
         "channels": "data/everestmntntop/channels.json",
@@ -26,6 +25,8 @@ class Everestmntntop:
         self.cooldown_timer = dataIO.load_json(self.config_files["cooldown"])
 
         self.cooldown = False
+        for name in self.comments:
+            bot.add_route(name, self.handle_quote_command)
 
     def _check_channel(self, channel):
         return channel in self.channels
@@ -48,6 +49,7 @@ class Everestmntntop:
         user = user.lower()
         if user not in self.comments:
             self.comments[user] = []
+            self.bot.add_route(user, self.handle_quote_command)
         if text not in self.comments[user]:
             self.comments[user].append(text)
             dataIO.save_json(self.config_files["comments"], self.comments)
@@ -95,38 +97,27 @@ class Everestmntntop:
                 if (len(cout) >= 1900):
                     cout = "\n".join(clist[:-1])
                     await self.bot.whisper("```%s```" % cout)
-                    time.sleep(100.0 / 1000.0)
                     clist = clist[-1:]
             await self.bot.whisper("```%s```" % cout)
 
-    async def handle_quote_command(self, message):
-        if message.author.id == self.bot.user.id or len(message.content) < 2 or message.channel.is_private:
+    async def handle_quote_command(self, parsed):
+        message = parsed.message
+        if message.author.id == self.bot.user.id or len(message.content) < 2:
             return
 
         if not self._check_channel(message.channel.id):
             return
 
-        if not user_allowed(message):
-            return
-
-        prefix = self.get_prefix(message)
-        if prefix:
-            cmd = message.content[len(prefix):]
-            if cmd.lower() in self.comments and not self.cooldown:
-                self.cooldown = True
-                Timer(self.cooldown_timer, self.setCooldownFalse, [], {}).start()
-                comment = random.choice(self.comments[cmd.lower()])
-                await self.bot.send_message(message.channel, comment)
+        cmd = parsed.invoked + parsed.args
+        if cmd.lower() in self.comments and not self.cooldown:
+            self.cooldown = True
+            Timer(self.cooldown_timer, self.setCooldownFalse, [], {}).start()
+            comment = random.choice(self.comments[cmd.lower()])
+            await self.bot.send_message(message.channel, comment)
 
     def setCooldownFalse(self):
         self.cooldown = False
 
-    def get_prefix(self, message):
-        for p in self.bot.settings.get_prefixes(message.server):
-            if message.content.startswith(p):
-                return p
-        return None
-
 
 def check_folders():
     if not os.path.exists("data/everestmntntop"):
@@ -146,6 +137,4 @@ def check_files():
 def setup(bot):
     check_folders()
     check_files()
-    n = Everestmntntop(bot)
-    bot.add_listener(n.handle_quote_command, "on_message")
-    bot.add_cog(n)
+    bot.add_cog(Everestmntntop(bot))
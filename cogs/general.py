@@ -1,6 +1,7 @@
 import discord
 from discord.ext import commands
 from .utils.chat_formatting import escape_mass_mentions, italics, pagify
+from .utils.outbox import PRIORITY_LOW
 from random import randint
 from random import choice
 from enum import Enum
@@ -70,7 +71,8 @@ class General:
         author = ctx.message.author
         if number > 1:
             n = randint(1, number)
-            await self.bot.say("{} :game_die: {} :game_die:".format(author.mention, n))
+            await self.bot.say("{} :game_die: {} :game_die:".format(author.mention, n),
+                               priority=PRIORITY_LOW, coalesce=True)
         else:
             await self.bot.say("{} Maybe higher than 1? ;P".format(author.mention))
 
@@ -119,13 +121,16 @@ class General:
 
         if outcome is True:
             await self.bot.say("{} You win {}!"
-                               "".format(red_choice.value, author.mention))
+                               "".format(red_choice.value, author.mention),
+                               priority=PRIORITY_LOW, coalesce=True)
         elif outcome is False:
             await self.bot.say("{} You lose {}!"
-                               "".format(red_choice.value, author.mention))
+                               "".format(red_choice.value, author.mention),
+                               priority=PRIORITY_LOW, coalesce=True)
         else:
             await self.bot.say("{} We're square {}!"
-                               "".format(red_choice.value, author.mention))
+                               "".format(red_choice.value, author.mention),
+                               priority=PRIORITY_LOW, coalesce=True)
 
     @commands.command(name="8", aliases=["8ball"])
     async def _8ball(self, *, question : str):
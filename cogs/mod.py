@@ -1,10 +1,18 @@
 import discord
 from discord.ext import commands
 from .utils.dataIO import dataIO
-from .utils import checks
+from .utils.storage import open_storage
+from .utils import checks, logs
+from .utils.outbox import PRIORITY_HIGH
+from .utils.metrics import metrics
+from .utils.wordfilter import WordFilter
+from .utils.repeats import RepeatDetector
+from .utils.expiring import ExpiringSet
+from .utils.caselog import CaseLog
+from .utils.namehistory import NameHistory
 from __main__ import send_cmd_help, settings
 from datetime import datetime
-from collections import deque, defaultdict, OrderedDict
+from collections import defaultdict
 from cogs.utils.chat_formatting import escape_mass_mentions, box, pagify
 import os
 import re
@@ -36,7 +44,12 @@ default_settings = {
     "ban_mention_spam"  : False,
     "delete_repeats"    : False,
     "mod-log"           : None,
-    "respect_hierarchy" : False
+    "respect_hierarchy" : False,
+    "filter_whole_words": False,
+    "filter_normalize"  : False,
+    "repeats_count"     : 3,
+    "repeats_seconds"   : 0,
+    "repeats_distance"  : None
 }
 
 
@@ -65,45 +78,22 @@ class NoModLogAccess(ModError):
     pass
 
 
-class TempCache:
-    """
-    This is how we avoid events such as ban and unban
-    from triggering twice in the mod-log.
-    Kinda hacky but functioning
-    """
-    def __init__(self, bot):
-        self.bot = bot
-        self._cache = []
-
-    def add(self, user, server, action, seconds=1):
-        tmp = (user.id, server.id, action)
-        self._cache.append(tmp)
-
-        async def delete_value():
-            await asyncio.sleep(seconds)
-            self._cache.remove(tmp)
-
-        self.bot.loop.create_task(delete_value())
-
-    def check(self, user, server, action):
-        return (user.id, server.id, action) in self._cache
-
-
 class Mod:
     """Moderation tools."""
 
     def __init__(self, bot):
         self.bot = bot
         self.ignore_list = dataIO.load_json("data/mod/ignorelist.json")
-        self.filter = dataIO.load_json("data/mod/filter.json")
-        self.past_names = dataIO.load_json("data/mod/past_names.json")
-        self.past_nicknames = dataIO.load_json("data/mod/past_nicknames.json")
+        self.filter = open_storage("data/mod/filter.json")
+        self._word_filters = {}
+        self.name_history = NameHistory("data/mod/names.db")
         settings = dataIO.load_json("data/mod/settings.json")
         self.settings = defaultdict(lambda: default_settings.copy(), settings)
-        self.cache = OrderedDict()
-        self.cases = dataIO.load_json("data/mod/modlog.json")
+        self.repeat_detector = RepeatDetector()
+        self.caselog = CaseLog("data/mod/modlog")
         self.last_case = defaultdict(dict)
-        self.temp_cache = TempCache(bot)
+        # Actions done by Red, so their events don't add a second case
+        self.temp_cache = ExpiringSet(1, name="mod_actions")
         perms_cache = dataIO.load_json("data/mod/perms_cache.json")
         self._perms_cache = defaultdict(dict, perms_cache)
 
@@ -196,12 +186,103 @@ class Mod:
             await self.bot.say("Repeated messages will be ignored.")
         dataIO.save_json("data/mod/settings.json", self.settings)
 
+    @modset.command(pass_context=True, no_pm=True)
+    async def repeats(self, ctx, count: int=None, seconds: int=0):
+        """Sets how many times in a row a message has to be repeated to be
+        deleted
+
+        If seconds is set, only the messages sent in that time count.
+        Between 2 and 10 times. Shows the current settings if none is
+        given"""
+        server = ctx.message.server
+        settings = self.settings[server.id]
+        if count is None:
+            msg = ("Messages sent {} times in a row".format(
+                settings.get("repeats_count", 3)))
+            if settings.get("repeats_seconds", 0):
+                msg += " within {} seconds".format(settings["repeats_seconds"])
+            if settings.get("repeats_distance") is not None:
+                msg += (", even if slightly different ({} bits),"
+                        "".format(settings["repeats_distance"]))
+            msg += (" are repeats.\nTracking the last messages of {} users "
+                    "across all servers in {:.1f} KB."
+                    "".format(len(self.repeat_detector),
+                              self.repeat_detector.memory() / 1024))
+            await self.bot.say(msg)
+            return
+        settings["repeats_count"] = min(max(count, 2), 10)
+        settings["repeats_seconds"] = max(seconds, 0)
+        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.repeat_detector.forget_server(server.id)
+        msg = ("Messages sent {} times in a row"
+               "".format(settings["repeats_count"]))
+        if settings["repeats_seconds"]:
+            msg += " within {} seconds".format(settings["repeats_seconds"])
+        msg += " will be treated as repeats."
+        if not settings["delete_repeats"]:
+            msg += " Use `{}modset deleterepeats` to delete them.".format(
+                ctx.prefix)
+        await self.bot.say(msg)
+
+    @modset.command(pass_context=True, no_pm=True)
+    async def nearrepeats(self, ctx, bits: int=None):
+        """Treats slightly different messages as repeats too
+
+        bits is how different they can be, between 1 and 16. Around 3 only
+        lets through small changes. Disabled if none is given"""
+        server = ctx.message.server
+        settings = self.settings[server.id]
+        if bits is None:
+            settings["repeats_distance"] = None
+            await self.bot.say("Only identical messages will be treated as "
+                               "repeats.")
+        else:
+            settings["repeats_distance"] = min(max(bits, 1), 16)
+            await self.bot.say("Messages differing by up to {} bits will be "
+                               "treated as repeats."
+                               "".format(settings["repeats_distance"]))
+        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.repeat_detector.forget_server(server.id)
+
+    @modset.command(pass_context=True, no_pm=True)
+    async def wholewords(self, ctx):
+        """Toggles matching only whole words with the filter"""
+        server = ctx.message.server
+        settings = self.settings[server.id]
+        if not settings.get("filter_whole_words", False):
+            settings["filter_whole_words"] = True
+            await self.bot.say("The filter will only match whole words.")
+        else:
+            settings["filter_whole_words"] = False
+            await self.bot.say("The filter will match words inside other "
+                               "words too.")
+        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.rebuild_word_filter(server)
+
+    @modset.command(pass_context=True, no_pm=True)
+    async def confusables(self, ctx):
+        """Toggles seeing through look-alike characters with the filter
+
+        Accents, invisible characters and letters of other alphabets or
+        styles resembling latin ones are ignored"""
+        server = ctx.message.server
+        settings = self.settings[server.id]
+        if not settings.get("filter_normalize", False):
+            settings["filter_normalize"] = True
+            await self.bot.say("The filter will see through look-alike "
+                               "characters.")
+        else:
+            settings["filter_normalize"] = False
+            await self.bot.say("The filter will only match the exact "
+                               "characters.")
+        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.rebuild_word_filter(server)
+
     @modset.command(pass_context=True, no_pm=True)
     async def resetcases(self, ctx):
         """Resets modlog's cases"""
         server = ctx.message.server
-        self.cases[server.id] = {}
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        self.caselog.reset(server.id)
         await self.bot.say("Cases have been reset.")
 
     @modset.command(pass_context=True, no_pm=True)
@@ -367,7 +448,7 @@ class Mod:
             return
 
         try:
-            self.temp_cache.add(user, server, "BAN")
+            self.temp_cache.add((user.id, server.id, "BAN"))
             await self.bot.ban(user, days)
             logger.info("{}({}) banned {}({}), deleting {} days worth of messages".format(
                 author.name, author.id, user.name, user.id, str(days)))
@@ -457,7 +538,7 @@ class Mod:
                               "You can now join the server again.{}".format(invite))
                 except:
                     pass
-                self.temp_cache.add(user, server, "BAN")
+                self.temp_cache.add((user.id, server.id, "BAN"))
                 await self.bot.ban(user, 1)
                 logger.info("{}({}) softbanned {}({}), deleting 1 day worth "
                     "of messages".format(author.name, author.id, user.name,
@@ -467,7 +548,7 @@ class Mod:
                                     mod=author,
                                     user=user,
                                     reason=reason)
-                self.temp_cache.add(user, server, "UNBAN")
+                self.temp_cache.add((user.id, server.id, "UNBAN"))
                 await self.bot.unban(server, user)
                 await self.bot.say("Done. Enough chaos.")
             except discord.errors.Forbidden:
@@ -876,14 +957,7 @@ class Mod:
         is_bot = self.bot.user.bot
         has_permissions = channel.permissions_for(server.me).manage_messages
 
-        prefixes = self.bot.command_prefix
-        if isinstance(prefixes, str):
-            prefixes = [prefixes]
-        elif callable(prefixes):
-            if asyncio.iscoroutine(prefixes):
-                await self.bot.say('Coroutine prefixes not yet implemented.')
-                return
-            prefixes = prefixes(self.bot, ctx.message)
+        prefixes = list(self.bot.settings.get_prefixes(server))
 
         # In case some idiot sets a null prefix
         if '' in prefixes:
@@ -1042,6 +1116,36 @@ class Mod:
         else:
             await self.bot.say("Case #{} updated.".format(case))
 
+    @commands.group(pass_context=True, no_pm=True)
+    @checks.mod_or_permissions(manage_messages=True)
+    async def cases(self, ctx):
+        """Looks up mod-log's cases"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @cases.command(pass_context=True, no_pm=True, name="user")
+    async def cases_user(self, ctx, user: str, page: int=1):
+        """Lists the cases of a user, newest first
+
+        The user can be a mention, a name or an ID, so users who have
+        left the server can be looked up too."""
+        server = ctx.message.server
+        user_id = self.find_user_id(server, user)
+        if user_id is None:
+            await self.bot.say("User not found.")
+            return
+        await self.show_cases(server, page, user_id=user_id)
+
+    @cases.command(pass_context=True, no_pm=True, name="by")
+    async def cases_by(self, ctx, mod: str, page: int=1):
+        """Lists the cases handled by a moderator, newest first"""
+        server = ctx.message.server
+        mod_id = self.find_user_id(server, mod)
+        if mod_id is None:
+            await self.bot.say("User not found.")
+            return
+        await self.show_cases(server, page, moderator_id=mod_id)
+
     @commands.group(pass_context=True, no_pm=True)
     @checks.admin_or_permissions(manage_channels=True)
     async def ignore(self, ctx):
@@ -1059,14 +1163,14 @@ class Mod:
         if not channel:
             if current_ch.id not in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].append(current_ch.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.save_ignore_list()
                 await self.bot.say("Channel added to ignore list.")
             else:
                 await self.bot.say("Channel already in ignore list.")
         else:
             if channel.id not in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].append(channel.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.save_ignore_list()
                 await self.bot.say("Channel added to ignore list.")
             else:
                 await self.bot.say("Channel already in ignore list.")
@@ -1077,7 +1181,7 @@ class Mod:
         server = ctx.message.server
         if server.id not in self.ignore_list["SERVERS"]:
             self.ignore_list["SERVERS"].append(server.id)
-            dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+            self.save_ignore_list()
             await self.bot.say("This server has been added to the ignore list.")
         else:
             await self.bot.say("This server is already being ignored.")
@@ -1099,14 +1203,14 @@ class Mod:
         if not channel:
             if current_ch.id in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].remove(current_ch.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.save_ignore_list()
                 await self.bot.say("This channel has been removed from the ignore list.")
             else:
                 await self.bot.say("This channel is not in the ignore list.")
         else:
             if channel.id in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].remove(channel.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                self.save_ignore_list()
                 await self.bot.say("Channel removed from ignore list.")
             else:
                 await self.bot.say("That channel is not in the ignore list.")
@@ -1117,11 +1221,15 @@ class Mod:
         server = ctx.message.server
         if server.id in self.ignore_list["SERVERS"]:
             self.ignore_list["SERVERS"].remove(server.id)
-            dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+            self.save_ignore_list()
             await self.bot.say("This server has been removed from the ignore list.")
         else:
             await self.bot.say("This server is not in the ignore list.")
 
+    def save_ignore_list(self):
+        dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+        self.bot.invalidate_access()
+
     def count_ignored(self):
         msg = "```Currently ignoring:\n"
         msg += str(len(self.ignore_list["CHANNELS"])) + " channels\n"
@@ -1170,7 +1278,8 @@ class Mod:
                 self.filter[server.id].append(w.lower())
                 added += 1
         if added:
-            dataIO.save_json("data/mod/filter.json", self.filter)
+            self.filter.save(server.id)
+            self.rebuild_word_filter(server)
             await self.bot.say("Words added to filter.")
         else:
             await self.bot.say("Words already in the filter.")
@@ -1196,7 +1305,8 @@ class Mod:
                 self.filter[server.id].remove(w.lower())
                 removed += 1
         if removed:
-            dataIO.save_json("data/mod/filter.json", self.filter)
+            self.filter.save(server.id)
+            self.rebuild_word_filter(server)
             await self.bot.say("Words removed from filter.")
         else:
             await self.bot.say("Those words weren't in the filter.")
@@ -1258,21 +1368,18 @@ class Mod:
     async def names(self, user : discord.Member):
         """Show previous names/nicknames of a user"""
         server = user.server
-        names = self.past_names[user.id] if user.id in self.past_names else None
-        try:
-            nicks = self.past_nicknames[server.id][user.id]
-            nicks = [escape_mass_mentions(nick) for nick in nicks]
-        except:
-            nicks = None
+        names = self.name_history.get(user.id)
+        nicks = self.name_history.get(user.id, server.id)
         msg = ""
         if names:
             names = [escape_mass_mentions(name) for name in names]
-            msg += "**Past 20 names**:\n"
+            msg += "**Past {} names**:\n".format(self.name_history.size)
             msg += ", ".join(names)
         if nicks:
+            nicks = [escape_mass_mentions(nick) for nick in nicks]
             if msg:
                 msg += "\n\n"
-            msg += "**Past 20 nicknames**:\n"
+            msg += "**Past {} nicknames**:\n".format(self.name_history.size)
             msg += ", ".join(nicks)
         if msg:
             await self.bot.say(msg)
@@ -1367,13 +1474,8 @@ class Mod:
         if mod_channel is None:
             return None
 
-        if server.id not in self.cases:
-            self.cases[server.id] = {}
-
-        case_n = len(self.cases[server.id]) + 1
-
         case = {
-            "case"         : case_n,
+            "case"         : None,
             "created"      : datetime.utcnow().timestamp(),
             "modified"     : None,
             "action"       : action,
@@ -1389,20 +1491,22 @@ class Mod:
             "until"        : until.timestamp() if until else None,
         }
 
+        # The case number is claimed before sending the message so that
+        # other processes sharing the data folder can't reuse it
+        case_n = self.caselog.add(server.id, case)
+
+        if mod:
+            self.last_case[server.id][mod.id] = case_n
+
         case_msg = self.format_case_msg(case)
 
         try:
-            msg = await self.bot.send_message(mod_channel, case_msg)
-            case["message"] = msg.id
+            msg = await self.bot.send_message(mod_channel, case_msg,
+                                              priority=PRIORITY_HIGH)
         except:
             pass
-
-        self.cases[server.id][str(case_n)] = case
-
-        if mod:
-            self.last_case[server.id][mod.id] = case_n
-
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        else:
+            self.caselog.update(server.id, case_n, {"message": msg.id})
 
         return case_n
 
@@ -1412,30 +1516,31 @@ class Mod:
         if channel is None:
             raise NoModLogChannel()
 
-        case = str(case)
-        case = self.cases[server.id][case]
+        with self.caselog.lock(server.id):
+            case_n = case
+            case = self.caselog.get(server.id, case_n)
+            changes = {}
 
-        if case["moderator_id"] is not None:
-            if case["moderator_id"] != mod.id:
-                if self.is_admin_or_superior(mod):
-                    case["amended_by"] = str(mod)
-                    case["amended_id"] = mod.id
-                else:
-                    raise UnauthorizedCaseEdit()
-        else:
-            case["moderator"] = str(mod)
-            case["moderator_id"] = mod.id
-
-        if case["reason"]:  # Existing reason
-            case["modified"] = datetime.utcnow().timestamp()
-        case["reason"] = reason
+            if case["moderator_id"] is not None:
+                if case["moderator_id"] != mod.id:
+                    if self.is_admin_or_superior(mod):
+                        changes["amended_by"] = str(mod)
+                        changes["amended_id"] = mod.id
+                    else:
+                        raise UnauthorizedCaseEdit()
+            else:
+                changes["moderator"] = str(mod)
+                changes["moderator_id"] = mod.id
 
-        if until is not False:
-            case["until"] = until
+            if case["reason"]:  # Existing reason
+                changes["modified"] = datetime.utcnow().timestamp()
+            changes["reason"] = reason
 
-        case_msg = self.format_case_msg(case)
+            if until is not False:
+                changes["until"] = until
 
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+            case = self.caselog.update(server.id, case_n, changes)
+            case_msg = self.format_case_msg(case)
 
         if case["message"] is None:  # The case's message was never sent
             raise CaseMessageNotFound()
@@ -1450,6 +1555,43 @@ class Mod:
             await self.bot.edit_message(msg, case_msg)
 
 
+    def find_user_id(self, server, user):
+        match = re.match(r"<@!?([0-9]+)>$", user) or re.match(r"([0-9]+)$",
+                                                             user)
+        if match:
+            return match.group(1)
+        member = server.get_member_named(user)
+        return member.id if member is not None else None
+
+    async def show_cases(self, server, page, **filters):
+        per_page = 10
+        total, cases = self.caselog.query(server.id, page=max(page, 1),
+                                          per_page=per_page, **filters)
+        pages = (total + per_page - 1) // per_page
+        if not total:
+            await self.bot.say("No cases found.")
+            return
+        elif not cases:
+            await self.bot.say("There are only {} pages.".format(pages))
+            return
+        msg = "Page {}/{} ({} cases)\n\n".format(page, pages, total)
+        msg += "\n".join(self.format_case_line(c) for c in cases)
+        for page in pagify(msg, shorten_by=16):
+            await self.bot.say(box(page))
+
+    def format_case_line(self, case):
+        created = case.get("created")
+        if created:
+            created = datetime.utcfromtimestamp(created)
+            created = created.strftime("%Y-%m-%d %H:%M")
+        action = ACTIONS_REPR.get(case["action"], (case["action"],))[0]
+        reason = case["reason"] or "No reason"
+        if len(reason) > 80:
+            reason = reason[:77] + "..."
+        return "#{} {} {} | {} | by {} | {}".format(
+            case["case"], created or "-", action, case["user"],
+            case["moderator"] or "Unknown", reason)
+
     def format_case_msg(self, case):
         tmp = case.copy()
         if case["reason"] is None:
@@ -1502,19 +1644,43 @@ class Mod:
 
         return case_msg
 
+    def get_word_filter(self, server):
+        """Returns the server's filter compiled into a WordFilter"""
+        try:
+            return self._word_filters[server.id]
+        except KeyError:
+            pass
+        settings = self.settings.get(server.id, default_settings)
+        word_filter = WordFilter(
+            self.filter.get(server.id, []),
+            whole_words=settings.get("filter_whole_words", False),
+            normalize=settings.get("filter_normalize", False))
+        metrics.observe("red_filter_build_seconds", word_filter.build_time)
+        self._word_filters[server.id] = word_filter
+        return word_filter
+
+    def rebuild_word_filter(self, server):
+        self._word_filters.pop(server.id, None)
+        word_filter = self.get_word_filter(server)
+        logger.info("Filter of server {} compiled: {} words, {} states, "
+                    "{:.1f}ms".format(server.id, len(word_filter.words),
+                                      len(word_filter),
+                                      word_filter.build_time * 1000))
+
     async def check_filter(self, message):
         server = message.server
-        if server.id in self.filter.keys():
-            for w in self.filter[server.id]:
-                if w in message.content.lower():
-                    try:
-                        await self.bot.delete_message(message)
-                        logger.info("Message deleted in server {}."
-                                    "Filtered: {}"
-                                    "".format(server.id, w))
-                        return True
-                    except:
-                        pass
+        # Servers without filtered words get an empty WordFilter, cached
+        # too, so the storage isn't queried for every message
+        w = self.get_word_filter(server).search(message.content)
+        if w is not None:
+            try:
+                await self.bot.delete_message(message)
+                logger.info("Message deleted in server {}."
+                            "Filtered: {}"
+                            "".format(server.id, w))
+                return True
+            except:
+                pass
         return False
 
     async def check_duplicates(self, message):
@@ -1522,17 +1688,16 @@ class Mod:
         author = message.author
         if server.id not in self.settings:
             return False
-        if self.settings[server.id]["delete_repeats"]:
+        settings = self.settings[server.id]
+        if settings["delete_repeats"]:
             if not message.content:
                 return False
-            if author.id not in self.cache:
-                self.cache[author.id] = deque(maxlen=3)
-            self.cache.move_to_end(author.id)
-            while len(self.cache) > 100000:
-                self.cache.popitem(last=False) # the oldest gets discarded
-            self.cache[author.id].append(message.content)
-            msgs = self.cache[author.id]
-            if len(msgs) == 3 and msgs[0] == msgs[1] == msgs[2]:
+            repeated = self.repeat_detector.check(
+                server.id, author.id, message.content,
+                count=settings.get("repeats_count", 3),
+                seconds=settings.get("repeats_seconds", 0),
+                max_distance=settings.get("repeats_distance"))
+            if repeated:
                 try:
                     await self.bot.delete_message(message)
                     return True
@@ -1550,7 +1715,7 @@ class Mod:
             mentions = set(message.mentions)
             if len(mentions) >= max_mentions:
                 try:
-                    self.temp_cache.add(author, server, "BAN")
+                    self.temp_cache.add((author.id, server.id, "BAN"))
                     await self.bot.ban(author, 1)
                 except:
                     logger.info("Failed to ban member for mention spam in "
@@ -1622,42 +1787,23 @@ class Mod:
 
     async def on_member_ban(self, member):
         server = member.server
-        if not self.temp_cache.check(member, server, "BAN"):
+        if (member.id, server.id, "BAN") not in self.temp_cache:
             await self.new_case(server,
                                 user=member,
                                 action="BAN")
 
     async def on_member_unban(self, server, user):
-        if not self.temp_cache.check(user, server, "UNBAN"):
+        if (user.id, server.id, "UNBAN") not in self.temp_cache:
             await self.new_case(server,
                                 user=user,
                                 action="UNBAN")
 
     async def check_names(self, before, after):
         if before.name != after.name:
-            if before.id not in self.past_names:
-                self.past_names[before.id] = [after.name]
-            else:
-                if after.name not in self.past_names[before.id]:
-                    names = deque(self.past_names[before.id], maxlen=20)
-                    names.append(after.name)
-                    self.past_names[before.id] = list(names)
-            dataIO.save_json("data/mod/past_names.json", self.past_names)
+            self.name_history.add(before.id, after.name)
 
         if before.nick != after.nick and after.nick is not None:
-            server = before.server
-            if server.id not in self.past_nicknames:
-                self.past_nicknames[server.id] = {}
-            if before.id in self.past_nicknames[server.id]:
-                nicks = deque(self.past_nicknames[server.id][before.id],
-                              maxlen=20)
-            else:
-                nicks = []
-            if after.nick not in nicks:
-                nicks.append(after.nick)
-                self.past_nicknames[server.id][before.id] = list(nicks)
-                dataIO.save_json("data/mod/past_nicknames.json",
-                                 self.past_nicknames)
+            self.name_history.add(before.id, after.nick, before.server.id)
 
     def are_overwrites_empty(self, overwrites):
         """There is currently no cleaner way to check if a
@@ -1666,6 +1812,18 @@ class Mod:
         empty = [p for p in iter(discord.PermissionOverwrite())]
         return original == empty
 
+    def __unload(self):
+        self.filter.close()
+        self.caselog.close()
+        self.name_history.close()
+
+    def __snapshot__(self):
+        """Fingerprints of the last messages seen by the repeats filter"""
+        return self.repeat_detector.snapshot()
+
+    def __restore__(self, snapshot):
+        self.repeat_detector.restore(snapshot)
+
 
 def strfdelta(delta):
     s = []
@@ -1689,7 +1847,7 @@ def strfdelta(delta):
 
 
 def check_folders():
-    folders = ("data", "data/mod/")
+    folders = ("data", "data/mod/", "data/mod/modlog")
     for folder in folders:
         if not os.path.exists(folder):
             print("Creating " + folder + " folder...")
@@ -1702,10 +1860,7 @@ def check_files():
     files = {
         "ignorelist.json"     : ignore_list,
         "filter.json"         : {},
-        "past_names.json"     : {},
-        "past_nicknames.json" : {},
         "settings.json"       : {},
-        "modlog.json"         : {},
         "perms_cache.json"    : {}
     }
 
@@ -1714,6 +1869,39 @@ def check_files():
             print("Creating empty {}".format(filename))
             dataIO.save_json("data/mod/{}".format(filename), value)
 
+    if os.path.isfile("data/mod/modlog.json"):
+        print("Splitting modlog.json into per-server files...")
+        dataIO.migrate_to_shards("data/mod/modlog.json", "data/mod/modlog")
+
+    for filename, server in (("past_names.json", False),
+                             ("past_nicknames.json", True)):
+        path = "data/mod/{}".format(filename)
+        if os.path.isfile(path):
+            print("Moving {} to names.db...".format(filename))
+            migrate_names(path, server)
+
+
+def migrate_names(path, server):
+    """Imports the names of past_names.json, or the nicknames of
+    past_nicknames.json, into the name history. The file is renamed to
+    *.bak once done"""
+    history = NameHistory("data/mod/names.db")
+    # Recorded along with the names, so that they aren't imported twice if
+    # Red stopped before the file was renamed
+    source = os.path.basename(path)
+    if not history.imported(source):
+        data = dataIO.load_json(path)
+        if server:
+            entries = ((user_id, server_id, nicks)
+                       for server_id, users in data.items()
+                       for user_id, nicks in users.items())
+        else:
+            entries = ((user_id, "", names)
+                       for user_id, names in data.items())
+        history.add_many(entries, source=source)
+    history.close()
+    os.replace(path, path + ".bak")
+
 
 def setup(bot):
     global logger
@@ -1727,7 +1915,7 @@ def setup(bot):
             filename='data/mod/mod.log', encoding='utf-8', mode='a')
         handler.setFormatter(
             logging.Formatter('%(asctime)s %(message)s', datefmt="[%d/%m/%Y %H:%M]"))
-        logger.addHandler(handler)
+        logs.pipeline.attach(logger, handler)
     n = Mod(bot)
     bot.add_listener(n.check_names, "on_member_update")
     bot.add_cog(n)
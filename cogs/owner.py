@@ -5,6 +5,8 @@ from cogs.utils.converters import GlobalUser
 from __main__ import set_cog
 from .utils.dataIO import dataIO
 from .utils.chat_formatting import pagify, box
+from .utils.metrics import metrics
+from .utils.loopmonitor import monitor
 
 import importlib
 import traceback
@@ -14,6 +16,7 @@ import threading
 import datetime
 import glob
 import os
+import sys
 import aiohttp
 
 log = logging.getLogger("red.owner")
@@ -171,6 +174,8 @@ class Owner:
 
         # Extracting filename from __module__ Example: cogs.owner
         loaded = [c.__module__.split(".")[1] for c in self.bot.cogs.values()]
+        # Enabled but waiting for the first use of a command or event
+        loaded += [m.split(".")[1] for m in self.bot.lazy_cogs]
         # What's in the folder but not loaded is unloaded
         unloaded = [c.split(".")[1] for c in self._list_cogs()
                     if c.split(".")[1] not in loaded]
@@ -723,6 +728,7 @@ class Owner:
                 cmd_obj.hidden = True
             except:
                 pass
+        self.bot.invalidate_help()
 
     @commands.command()
     @checks.is_owner()
@@ -918,6 +924,56 @@ class Owner:
         else:
             await self.bot.say("No exception has occurred yet.")
 
+    @commands.command()
+    @checks.is_owner()
+    async def metrics(self, top: int=10):
+        """Shows where Red spends its time since the start
+
+        Commands and listeners are sorted by total time"""
+        def table(name, label):
+            lines = ["{:<32} {:>7} {:>9} {:>9} {:>9}".format(
+                label.capitalize(), "calls", "total s", "p95 ms", "max ms")]
+            for labels, h in metrics.top(name, top):
+                lines.append("{:<32} {:>7} {:>9.2f} {:>9.1f} {:>9.1f}".format(
+                    labels[label][:32], h.count, h.sum,
+                    h.quantile(0.95) * 1000, h.max * 1000))
+            return "\n".join(lines)
+
+        msg = table("red_command_seconds", "command") + "\n\n"
+        msg += table("red_listener_seconds", "listener") + "\n\n"
+        msg += "API requests: {}\n".format(
+            metrics.total("red_api_requests_total"))
+        msg += "Data saves: {} ({:.1f} MB written)".format(
+            metrics.total("red_dataio_saves_total"),
+            metrics.total("red_dataio_written_bytes_total") / 1024 ** 2)
+        for page in pagify(msg, ["\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
+    @commands.command()
+    @checks.is_owner()
+    async def stalls(self, amount: int=10):
+        """Shows the latest event loop stalls and the code causing them
+
+        Requires Red to be started with --profile-loop"""
+        if not monitor.running:
+            await self.bot.say("The event loop isn't being monitored. Start "
+                               "Red with `--profile-loop` to enable it.")
+            return
+        stalls = list(monitor.stalls)[-amount:]
+        if not stalls:
+            await self.bot.say("The event loop hasn't been blocked for longer "
+                               "than {:.0f}ms yet."
+                               "".format(monitor.threshold * 1000))
+            return
+        msg = ""
+        for stall in reversed(stalls):
+            when = datetime.datetime.utcfromtimestamp(stall.started_at)
+            msg += "{} UTC {:>7.0f}ms {}\n".format(
+                when.strftime("%Y-%m-%d %H:%M:%S"), stall.duration * 1000,
+                stall.location)
+        for page in pagify(msg, ["\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
     def _populate_list(self, _list):
         """Used for both whitelist / blacklist
 
@@ -942,19 +998,75 @@ class Owner:
     def _load_cog(self, cogname):
         if not self._does_cogfile_exist(cogname):
             raise CogNotFoundError(cogname)
+        self.bot.discard_lazy_cog(cogname)
+        before = self._get_footprint()
         try:
-            mod_obj = importlib.import_module(cogname)
-            importlib.reload(mod_obj)
+            if cogname in sys.modules:
+                mod_obj = importlib.reload(sys.modules[cogname])
+            else:
+                mod_obj = importlib.import_module(cogname)
             self.bot.load_extension(mod_obj.__name__)
         except SyntaxError as e:
             raise CogLoadError(*e.args)
         except:
             raise
+        try:
+            self._save_manifest(cogname, before)
+        except Exception as e:
+            log.exception("Couldn't save the manifest of {}".format(cogname),
+                          exc_info=e)
+
+    def _get_footprint(self):
+        """What's registered in the bot, to be compared with what's there
+        after loading a cog"""
+        bot = self.bot
+        events = {name: list(funcs) for name, funcs
+                  in bot.extra_events.items()}
+        return (set(bot.cogs), set(bot.commands), events,
+                _all_tasks(bot.loop), _all_routes(bot))
+
+    def _save_manifest(self, cogname, before):
+        """Records what loading the cog added to the bot
+
+        The next boot Red registers stubs of its commands and only loads it
+        when one of them is invoked or one of its events is dispatched"""
+        cogs, names, events, tasks, routes = before
+        bot = self.bot
+        new_cogs = sorted(name for name in bot.cogs if name not in cogs)
+        new_commands = {}
+        for command in set(bot.commands.values()):
+            if command.name not in names:
+                new_commands[command.name] = _manifest_entry(command)
+        new_events = sorted(name for name, funcs in bot.extra_events.items()
+                            if any(f not in events.get(name, [])
+                                   for f in funcs))
+        # Cogs whose routes come from their data, like custom commands,
+        # declare it with __routes__ = True since they may have none yet
+        new_routes = (bool(_all_routes(bot) - routes) or
+                      any(getattr(bot.cogs[name], "__routes__", False)
+                          for name in new_cogs))
+        manifest = {
+            "mtime": os.path.getmtime(sys.modules[cogname].__file__),
+            "cogs": new_cogs,
+            "commands": new_commands,
+            "events": new_events,
+            "routes": new_routes,
+            # Cogs starting tasks, e.g. pollers, are loaded once logged in
+            "background": bool(_all_tasks(bot.loop) - tasks)
+        }
+        try:
+            manifests = dataIO.load_json("data/red/cog_manifests.json")
+        except FileNotFoundError:
+            manifests = {}
+        if manifests.get(cogname) != manifest:
+            manifests[cogname] = manifest
+            dataIO.save_json("data/red/cog_manifests.json", manifests)
 
     def _unload_cog(self, cogname, reloading=False):
         if not reloading and cogname == "cogs.owner":
             raise OwnerUnloadWithoutReloadError(
                 "Can't unload the owner plugin :P")
+        self.bot.discard_lazy_cog(cogname)
         try:
             self.bot.unload_extension(cogname)
         except:
@@ -1053,9 +1165,37 @@ class Owner:
 
     def save_global_ignores(self):
         dataIO.save_json("data/red/global_ignores.json", self.global_ignores)
+        self.bot.invalidate_access()
 
     def save_disabled_commands(self):
         dataIO.save_json("data/red/disabled_commands.json", self.disabled_commands)
+        self.bot.invalidate_help()
+
+
+def _all_tasks(loop):
+    try:
+        return set(asyncio.all_tasks(loop))
+    except AttributeError:  # Python < 3.7
+        return set(asyncio.Task.all_tasks(loop))
+
+
+def _manifest_entry(command):
+    entry = {
+        "aliases": command.aliases,
+        "help": command.help,
+        "hidden": command.hidden,
+        "cog": command.cog_name
+    }
+    if isinstance(command, commands.GroupMixin):
+        # Listed by help before the cog is loaded
+        entry["commands"] = {sub.name: _manifest_entry(sub)
+                             for sub in set(command.commands.values())}
+    return entry
+
+
+def _all_routes(bot):
+    return {(key, handler) for key, handlers in bot._routes.items()
+            for handler in handlers}
 
 
 def _import_old_data(data):
@@ -1,8 +1,10 @@
 from discord.ext import commands
 from .utils.dataIO import dataIO
+from .utils.migrations import migrations
+from .utils.outbox import PRIORITY_LOW
 from .utils.chat_formatting import escape_mass_mentions
 from .utils import checks
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from string import ascii_letters
 from random import choice
 import discord
@@ -34,6 +36,10 @@ class OfflineStream(StreamsError):
     pass
 
 
+# A notification restored from a snapshot. Has what's needed to delete it
+SentNotification = namedtuple("SentNotification", "id channel server")
+
+
 class Streams:
     """Streams
 
@@ -48,6 +54,8 @@ class Streams:
         settings = dataIO.load_json("data/streams/settings.json")
         self.settings = defaultdict(dict, settings)
         self.messages_cache = defaultdict(list)
+        migrations.register("data/streams/twitch.json", 1,
+                            self._migration_twitch_v5)
 
     @commands.command()
     async def hitbox(self, stream: str):
@@ -561,7 +569,9 @@ class Streams:
         CHECK_DELAY = 60
 
         try:
-            await self._migration_twitch_v5()
+            if await migrations.run_async("data/streams/twitch.json"):
+                self.twitch_streams = dataIO.load_json("data/streams/"
+                                                       "twitch.json")
         except InvalidCredentials:
             print("Error during convertion of twitch usernames to IDs: "
                   "invalid token")
@@ -600,7 +610,7 @@ class Streams:
                             continue
                         save = True
                         stream["ALREADY_ONLINE"] = True
-                        messages_sent = []
+                        notifications = []
                         for channel_id in stream["CHANNELS"]:
                             channel = self.bot.get_channel(channel_id)
                             if channel is None:
@@ -609,9 +619,14 @@ class Streams:
                             can_speak = channel.permissions_for(channel.server.me).send_messages
                             message = mention + " {} is live!".format(stream["NAME"])
                             if channel and can_speak:
-                                m = await self.bot.send_message(channel, message, embed=embed)
-                                messages_sent.append(m)
-                        self.messages_cache[key] = messages_sent
+                                notifications.append(self.bot.send_message(
+                                    channel, message, embed=embed,
+                                    priority=PRIORITY_LOW))
+                        # Sent to every channel at once
+                        results = await asyncio.gather(*notifications,
+                                                       return_exceptions=True)
+                        self.messages_cache[key] = [m for m in results if not
+                                                    isinstance(m, Exception)]
 
                     await asyncio.sleep(0.5)
 
@@ -636,14 +651,29 @@ class Streams:
 
         del self.messages_cache[key]
 
+    def __snapshot__(self):
+        """Live notifications to delete when their stream goes offline"""
+        return [[parser.__name__, stream, [[m.channel.id, m.id]
+                                           for m in messages]]
+                for (parser, stream), messages in self.messages_cache.items()]
+
+    def __restore__(self, cache):
+        for parser, stream, messages in cache:
+            key = (getattr(self, parser), stream)
+            for channel_id, message_id in messages:
+                channel = self.bot.get_channel(channel_id)
+                if channel is not None:
+                    self.messages_cache[key].append(
+                        SentNotification(message_id, channel, channel.server))
+
     def rnd_attr(self):
         """Avoids Discord's caching"""
         return "?rnd=" + "".join([choice(ascii_letters) for i in range(6)])
 
-    async def _migration_twitch_v5(self):
+    async def _migration_twitch_v5(self, twitch_streams):
         #  Migration of old twitch streams to API v5
         to_convert = []
-        for stream in self.twitch_streams:
+        for stream in twitch_streams:
             if "ID" not in stream:
                 to_convert.append(stream["NAME"])
 
@@ -652,15 +682,13 @@ class Streams:
 
         results = await self.fetch_twitch_ids(*to_convert)
 
-        for stream in self.twitch_streams:
+        for stream in twitch_streams:
             for result in results:
                 if stream["NAME"].lower() == result["name"].lower():
                     stream["ID"] = result["_id"]
 
         # We might as well delete the invalid / renamed ones
-        self.twitch_streams = [s for s in self.twitch_streams if "ID" in s]
-
-        dataIO.save_json("data/streams/twitch.json", self.twitch_streams)
+        return [s for s in twitch_streams if "ID" in s]
 
 
 def check_folders():
@@ -105,7 +105,8 @@ class Trivia:
                 await self.bot.say("Error loading the trivia list.")
             else:
                 settings = self.settings[server.id]
-                t = TriviaSession(self.bot, trivia_list, message, settings)
+                t = TriviaSession(self.bot, trivia_list, message.channel,
+                                  message.author, settings)
                 self.trivia_sessions.append(t)
                 await t.new_question()
         else:
@@ -201,9 +202,33 @@ class Trivia:
     def save_settings(self):
         dataIO.save_json(self.file_path, self.settings)
 
+    def __snapshot__(self):
+        """Ongoing sessions. Their current question is asked again"""
+        return [t.snapshot() for t in self.trivia_sessions
+                if t.status != "stop"]
+
+    def __restore__(self, sessions):
+        for saved in sessions:
+            channel = self.bot.get_channel(saved["CHANNEL"])
+            if channel is None or self.get_trivia_by_channel(channel):
+                continue
+            server = channel.server
+            questions = [TriviaLine(*line) for line in saved["QUESTIONS"]]
+            t = TriviaSession(self.bot, questions, channel,
+                              server.get_member(saved["STARTER"]),
+                              self.settings[server.id])
+            t.count = saved["COUNT"]
+            for uid, score in saved["SCORES"]:
+                if uid == self.bot.user.id:
+                    t.scores[self.bot.user] = score
+                elif server.get_member(uid) is not None:
+                    t.scores[server.get_member(uid)] = score
+            self.trivia_sessions.append(t)
+            self.bot.loop.create_task(t.new_question())
+
 
 class TriviaSession():
-    def __init__(self, bot, trivia_list, message, settings):
+    def __init__(self, bot, trivia_list, channel, starter, settings):
         self.bot = bot
         self.reveal_messages = ("I know this one! {}!",
                                 "Easy: {}.",
@@ -214,8 +239,8 @@ class TriviaSession():
                               "\N{PENSIVE FACE} Next one.")
         self.current_line = None # {"QUESTION" : "String", "ANSWERS" : []}
         self.question_list = trivia_list
-        self.channel = message.channel
-        self.starter = message.author
+        self.channel = channel
+        self.starter = starter
         self.scores = Counter()
         self.status = "new question"
         self.timer = None
@@ -247,11 +272,12 @@ class TriviaSession():
         self.count += 1
         self.timer = int(time.perf_counter())
         msg = "**Question number {}!**\n\n{}".format(self.count, self.current_line.question)
-        await self.bot.say(msg)
+        await self.bot.send_message(self.channel, msg)
 
         while self.status != "correct answer" and abs(self.timer - int(time.perf_counter())) <= self.settings["DELAY"]:
             if abs(self.timeout - int(time.perf_counter())) >= self.settings["TIMEOUT"]:
-                await self.bot.say("Guys...? Well, I guess I'll stop then.")
+                await self.bot.send_message(self.channel, "Guys...? Well, I "
+                                            "guess I'll stop then.")
                 await self.stop_trivia()
                 return True
             await asyncio.sleep(1) #Waiting for an answer or for the time limit
@@ -271,8 +297,8 @@ class TriviaSession():
                 msg += " **+1** for me!"
                 self.scores[self.bot.user] += 1
             self.current_line = None
-            await self.bot.say(msg)
-            await self.bot.type()
+            await self.bot.send_message(self.channel, msg)
+            await self.bot.send_typing(self.channel)
             await asyncio.sleep(3)
             if not self.status == "stop":
                 await self.new_question()
@@ -281,7 +307,20 @@ class TriviaSession():
         t = "+ Results: \n\n"
         for user, score in self.scores.most_common():
             t += "+ {}\t{}\n".format(user, score)
-        await self.bot.say(box(t, lang="diff"))
+        await self.bot.send_message(self.channel, box(t, lang="diff"))
+
+    def snapshot(self):
+        questions = list(self.question_list)
+        count = self.count
+        if self.current_line is not None:  # Unanswered, asked again
+            questions.append(self.current_line)
+            count -= 1
+        return {"CHANNEL": self.channel.id,
+                "STARTER": getattr(self.starter, "id", None),
+                "QUESTIONS": [list(line) for line in questions],
+                "SCORES": [[user.id, score]
+                           for user, score in self.scores.items()],
+                "COUNT": count}
 
     async def check_answer(self, message):
         if message.author == self.bot.user:
@@ -0,0 +1,155 @@
+from bisect import bisect_left
+from collections import defaultdict
+from .dataIO import dataIO, LazyShards
+
+
+INDEXED = ("user_id", "moderator_id", "action")
+
+
+class _ServerIndex:
+    """Case numbers of a server's cases, in ascending order, grouped by the
+    values of their indexed fields"""
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.numbers = sorted(int(n) for n in shard)
+        self.next = self.numbers[-1] + 1 if self.numbers else 1
+        self.fields = {field: defaultdict(list) for field in INDEXED}
+        for n in self.numbers:
+            self.add(n, shard[str(n)])
+
+    def add(self, n, case):
+        for field, index in self.fields.items():
+            index[case.get(field)].append(n)
+
+    def remove(self, n, case):
+        for field, index in self.fields.items():
+            numbers = index[case.get(field)]
+            i = bisect_left(numbers, n)
+            if i < len(numbers) and numbers[i] == n:
+                del numbers[i]
+            if not numbers:
+                del index[case.get(field)]
+
+
+class CaseLog:
+    """Mod-log cases of every server, one shard per server
+
+    Cases are numbered from a per-server counter and indexed in memory
+    by user, moderator and action the first time a server's cases are
+    accessed, so numbering a case and looking up someone's cases don't
+    depend on how many cases the server has. Since numbers only grow the
+    number order is also the creation order."""
+
+    def __init__(self, directory):
+        self.path = directory
+        self.shards = LazyShards(directory)
+        self._indexes = {}
+
+    def lock(self, server_id):
+        return dataIO.lock(dataIO.shard_path(self.path, server_id))
+
+    def _index(self, server_id):
+        try:
+            shard = self.shards[server_id]
+        except KeyError:
+            shard = self.shards[server_id] = {}
+        index = self._indexes.get(server_id)
+        # The shard is a new object if another process changed it
+        if index is None or index.shard is not shard:
+            index = self._indexes[server_id] = _ServerIndex(shard)
+        return index
+
+    def add(self, server_id, case):
+        """Stores case with the next number of the server and returns it"""
+        with self.lock(server_id):
+            index = self._index(server_id)
+            n = index.next
+            index.next += 1
+            case["case"] = n
+            index.shard[str(n)] = case
+            index.numbers.append(n)
+            index.add(n, case)
+            self._save(server_id)
+        return n
+
+    def get(self, server_id, n):
+        """Returns the case numbered n. Raises KeyError if there's none"""
+        return self._index(server_id).shard[str(n)]
+
+    def update(self, server_id, n, changes):
+        """Applies the dict of changes to the case numbered n and returns
+        the case. Raises KeyError if there's none"""
+        with self.lock(server_id):
+            index = self._index(server_id)
+            case = index.shard[str(n)]
+            reindex = any(case.get(f) != changes[f]
+                          for f in INDEXED if f in changes)
+            if reindex:
+                index.remove(n, case)
+            case.update(changes)
+            if reindex:
+                index.add(n, case)
+            self._save(server_id)
+        return case
+
+    def reset(self, server_id):
+        """Deletes the server's cases. Numbering starts over"""
+        with self.lock(server_id):
+            self.shards[server_id] = {}
+            self._indexes.pop(server_id, None)
+            self._save(server_id)
+
+    def count(self, server_id):
+        if server_id not in self.shards:
+            return 0
+        return len(self._index(server_id).numbers)
+
+    def query(self, server_id, *, user_id=None, moderator_id=None,
+              action=None, since=None, page=1, per_page=10):
+        """Returns the total of the cases matching every filter given and
+        the page-th page of them, newest first
+
+        since is a timestamp: older cases are left out"""
+        if server_id not in self.shards:
+            return 0, []
+        index = self._index(server_id)
+        filters = {"user_id": user_id, "moderator_id": moderator_id,
+                   "action": action}
+        candidates = [index.fields[f].get(v, []) for f, v in filters.items()
+                      if v is not None]
+        if not candidates:
+            candidates = [index.numbers]
+        # Walks the smallest list, checking the others' fields on the cases
+        numbers = min(candidates, key=len)
+        checks = [(f, v) for f, v in filters.items() if v is not None]
+        start = (page - 1) * per_page
+        if len(candidates) > 1 or since is not None:
+            matches = []
+            for n in reversed(numbers):
+                case = index.shard[str(n)]
+                if since is not None and (case.get("created") or 0) < since:
+                    break
+                if all(case.get(f) == v for f, v in checks):
+                    matches.append(n)
+            total = len(matches)
+            matches = matches[start:start+per_page]
+        else:
+            total = len(numbers)
+            end = max(total - start, 0)
+            matches = reversed(numbers[max(end - per_page, 0):end])
+        return total, [index.shard[str(n)] for n in matches]
+
+    def _save(self, server_id):
+        # With other processes around the shard is written before the
+        # lock is released, so the case numbers they see are up to date
+        data = self.shards[server_id]
+        if dataIO.shared:
+            dataIO.save_shard(self.path, server_id, data)
+        else:
+            dataIO.mark_shard_dirty(self.path, server_id, data)
+
+    def close(self):
+        """Writes out every pending change"""
+        for server_id in self.shards:
+            dataIO.flush(dataIO.shard_path(self.path, server_id))
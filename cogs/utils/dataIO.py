@@ -1,7 +1,29 @@
 import json
 import os
+import asyncio
 import logging
+import zlib
+import weakref
+import threading
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from random import randint
+from .metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Compact: minified output, verified by checksumming the written bytes
+# Safe: pretty printed output, verified by parsing the written file
+# Paranoid: like safe, plus fsync of the file and of its folder
+MODE_COMPACT = "compact"
+MODE_SAFE = "safe"
+MODE_PARANOID = "paranoid"
+MODES = (MODE_COMPACT, MODE_SAFE, MODE_PARANOID)
+
 
 class InvalidFileIO(Exception):
     pass
@@ -9,27 +31,403 @@ class InvalidFileIO(Exception):
 class DataIO():
     def __init__(self):
         self.logger = logging.getLogger("red")
+        self.save_delay = 5
+        self._dirty = {}
+        self._flush_handles = {}
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        self._queued_saves = {}
+        self._writers = {}
+        self._issued = {}   # filename: number of the last save issued
+        self._written = {}  # filename: number of the last save written
+        self.default_mode = MODE_SAFE
+        self._modes = {}
+        self._lazy = []
+        self.shared = False
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._stamps = {}
+
+    @contextmanager
+    def lock(self, filename):
+        """Holds an exclusive lock on filename
+
+        When the data folder is shared with other processes the lock is
+        an advisory lock on filename.lock, otherwise it only excludes
+        other threads. The lock is reentrant."""
+        filename = os.path.normpath(filename)
+        with self._locks_guard:
+            entry = self._locks.setdefault(filename,
+                                           [threading.RLock(), None, 0])
+        entry[0].acquire()
+        try:
+            if entry[2] == 0 and self.shared and fcntl is not None:
+                entry[1] = open(filename + ".lock", mode="a")
+                fcntl.flock(entry[1].fileno(), fcntl.LOCK_EX)
+            entry[2] += 1
+            try:
+                yield
+            finally:
+                entry[2] -= 1
+                if entry[2] == 0 and entry[1] is not None:
+                    fcntl.flock(entry[1].fileno(), fcntl.LOCK_UN)
+                    entry[1].close()
+                    entry[1] = None
+        finally:
+            entry[0].release()
+
+    def update_json(self, filename, fn, *, default=None):
+        """Atomically applies fn to the data of filename and saves it
+
+        The file is locked, reloaded and passed to fn, then saved with
+        whatever fn returns (or the data itself if fn returns None).
+        If the file doesn't exist fn gets default instead.
+        Returns the saved data"""
+        with self.lock(filename):
+            try:
+                data = self.load_json(filename)
+            except FileNotFoundError:
+                data = default
+            result = fn(data)
+            if result is not None:
+                data = result
+            if not self.save_json(filename, data):
+                raise InvalidFileIO("Failed to save {}".format(filename))
+        return data
+
+    def has_changed(self, filename):
+        """Checks if filename was replaced or modified by someone else
+        since this process last loaded or saved it"""
+        stamp = self._stamps.get(os.path.normpath(filename))
+        return stamp is not None and stamp != self._stamp(filename)
+
+    def _stamp(self, filename):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _remember(self, filename):
+        self._stamps[os.path.normpath(filename)] = self._stamp(filename)
+
+    def deferred(self):
+        """Returns the lazily loaded files/folders not fully read yet"""
+        self._lazy = [ref for ref in self._lazy if ref() is not None]
+        return sorted(ref().path for ref in self._lazy if not ref().loaded)
+
+    def set_mode(self, path, mode):
+        """Sets the durability mode used to save path
+
+        path can be a file or a folder, in which case the mode applies
+        to the files directly inside it (e.g. shards).
+        Passing None as mode restores the default"""
+        if mode is not None and mode not in MODES:
+            raise InvalidFileIO("Unknown save mode: {}".format(mode))
+        path = os.path.normpath(path)
+        if mode is None:
+            self._modes.pop(path, None)
+        else:
+            self._modes[path] = mode
+
+    def get_mode(self, filename):
+        filename = os.path.normpath(filename)
+        try:
+            return self._modes[filename]
+        except KeyError:
+            return self._modes.get(os.path.dirname(filename),
+                                   self.default_mode)
 
     def save_json(self, filename, data):
-        """Atomically saves json file"""
+        """Atomically saves json file
+
+        Changes of filename waiting to be flushed are dropped once the
+        save succeeds. If it fails they're replaced by data and retried
+        after save_delay. Older asynchronous saves of filename still
+        waiting for their turn are dropped, and those in progress can't
+        overwrite it"""
+        seq = self._issue(filename)
+        queued = self._queued_saves.pop(filename, None)
+        pending = filename in self._dirty or (queued and queued[2])
+        try:
+            saved = self._atomic_save(filename, data, seq)
+        except Exception as e:
+            if queued is not None and not queued[1].cancelled():
+                queued[1].set_exception(e)
+            if pending:
+                self._retry_pending(filename, data)
+            raise
+        if queued is not None and not queued[1].cancelled():
+            queued[1].set_result(saved)
+        if saved:
+            self._discard_pending(filename)
+        elif pending:
+            self._retry_pending(filename, data)
+        return saved
+
+    async def save_json_async(self, filename, data):
+        """Atomically saves json file in the I/O executor
+
+        Saves to the same file are carried out in the order they were
+        issued. If a save is still waiting for its turn when a newer one
+        for the same file comes in, the older data is dropped and both
+        callers get the result of the newer save.
+        data is serialized outside of the event loop: pass a copy if it
+        could be modified before the save completes."""
+        loop = asyncio.get_event_loop()
+        # Pending changes are retried if this save fails
+        pending = filename in self._dirty
+        self._discard_pending(filename)
+        if filename in self._queued_saves:
+            _, fut, was_pending, _ = self._queued_saves[filename]
+            pending = pending or was_pending
+        else:
+            fut = loop.create_future()
+        seq = self._issue(filename)
+        self._queued_saves[filename] = (data, fut, pending, seq)
+        if filename not in self._writers:
+            writer = asyncio.ensure_future(self._async_writer(filename))
+            self._writers[filename] = writer
+        return await asyncio.shield(fut)
+
+    async def load_json_async(self, filename):
+        """Loads json file in the I/O executor
+
+        Waits for the queued saves of the same file to complete first"""
+        loop = asyncio.get_event_loop()
+        if self.is_dirty(filename):
+            self.flush(filename)
+        writer = self._writers.get(filename)
+        if writer is not None:
+            await asyncio.shield(writer)
+        return await loop.run_in_executor(self._executor,
+                                          self._read_json, filename)
+
+    async def join(self):
+        """Waits for all the queued asynchronous saves to complete"""
+        writers = list(self._writers.values())
+        if writers:
+            await asyncio.wait(writers)
+
+    async def _async_writer(self, filename):
+        loop = asyncio.get_event_loop()
+        try:
+            while filename in self._queued_saves:
+                data, fut, pending, seq = self._queued_saves.pop(filename)
+                try:
+                    result = await loop.run_in_executor(
+                        self._executor, self._atomic_save, filename, data,
+                        seq)
+                except Exception as e:
+                    result = False
+                    if not fut.cancelled():
+                        fut.set_exception(e)
+                else:
+                    if not fut.cancelled():
+                        fut.set_result(result)
+                if not result and pending and filename not in self._dirty:
+                    self._retry_pending(filename, data)
+        finally:
+            del self._writers[filename]
+
+    def _issue(self, filename):
+        seq = self._issued.get(filename, 0) + 1
+        self._issued[filename] = seq
+        return seq
+
+    def _atomic_save(self, filename, data, seq):
+        if isinstance(data, LazyJSON):
+            data = data.data
+        with self.lock(filename):
+            # A save issued later has already been written
+            if seq < self._written.get(filename, 0):
+                return True
+            if not self._write_file(filename, data):
+                return False
+            self._written[filename] = seq
+            self._remember(filename)
+        return True
+
+    def _write_file(self, filename, data):
+        mode = self.get_mode(filename)
         rnd = randint(1000, 9999)
         path, ext = os.path.splitext(filename)
-        tmp_file = "{}-{}.tmp".format(path, rnd)
-        self._save_json(tmp_file, data)
-        try:
-            self._read_json(tmp_file)
-        except json.decoder.JSONDecodeError:
-            self.logger.exception("Attempted to write file {} but JSON "
-                                  "integrity check on tmp file has failed. "
+        tmp_file = "{}-{}-{}.tmp".format(path, os.getpid(), rnd)
+        if mode == MODE_COMPACT:
+            raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+            checksum = zlib.crc32(raw)
+            with open(tmp_file, mode="wb") as f:
+                f.write(raw)
+            with open(tmp_file, mode="rb") as f:
+                valid = zlib.crc32(f.read()) == checksum
+            if not valid:
+                self.logger.error("Attempted to write file {} but the "
+                                  "checksum of the tmp file doesn't match. "
                                   "The original file is unaltered."
                                   "".format(filename))
-            return False
+                return False
+        else:
+            self._save_json(tmp_file, data, fsync=mode == MODE_PARANOID)
+            try:
+                self._read_json(tmp_file)
+            except json.decoder.JSONDecodeError:
+                self.logger.exception("Attempted to write file {} but JSON "
+                                      "integrity check on tmp file has "
+                                      "failed. The original file is "
+                                      "unaltered.".format(filename))
+                return False
         os.replace(tmp_file, filename)
+        if mode == MODE_PARANOID:
+            self._fsync_dir(os.path.dirname(filename))
+        metrics.inc("red_dataio_saves_total", mode=mode)
+        metrics.inc("red_dataio_written_bytes_total",
+                    os.path.getsize(filename), mode=mode)
         return True
 
+    def _fsync_dir(self, directory):
+        if os.name == "nt":  # Folders can't be opened on Windows
+            return
+        fd = os.open(directory or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def mark_dirty(self, filename, data, *, delay=None):
+        """Schedules data to be saved to filename
+
+        Repeated calls for the same file before the delay (in seconds)
+        expires are coalesced into a single save_json call with the
+        latest data. If no delay is passed save_delay is used."""
+        if delay is None:
+            delay = self.save_delay
+        self._dirty[filename] = data
+        if delay <= 0:
+            return self.flush(filename)
+        if filename not in self._flush_handles:
+            loop = asyncio.get_event_loop()
+            handle = loop.call_later(delay, self._flush_one, filename)
+            self._flush_handles[filename] = handle
+        return True
+
+    def is_dirty(self, filename):
+        """Checks if filename has changes waiting to be flushed"""
+        return filename in self._dirty
+
+    def flush(self, filename=None):
+        """Saves pending changes right away
+
+        If filename is None every dirty file gets saved.
+        Returns False if any of the saves has failed"""
+        if filename is None:
+            filenames = list(self._dirty)
+        else:
+            filenames = [filename]
+        success = True
+        for f in filenames:
+            if not self._flush_one(f):
+                success = False
+        return success
+
+    def _discard_pending(self, filename):
+        handle = self._flush_handles.pop(filename, None)
+        if handle is not None:
+            handle.cancel()
+        self._dirty.pop(filename, None)
+
+    def _retry_pending(self, filename, data):
+        self.logger.warning("Failed to save {}, retrying in {} seconds"
+                            "".format(filename, self.save_delay))
+        self._dirty[filename] = data
+        handle = self._flush_handles.pop(filename, None)
+        if handle is not None:
+            handle.cancel()
+        loop = asyncio.get_event_loop()
+        handle = loop.call_later(self.save_delay, self._flush_one, filename)
+        self._flush_handles[filename] = handle
+
+    def _flush_one(self, filename):
+        handle = self._flush_handles.pop(filename, None)
+        if handle is not None:  # Not needed if flushed before the delay
+            handle.cancel()
+        if filename not in self._dirty:
+            return True
+        data = self._dirty[filename]
+        try:
+            return self.save_json(filename, data)
+        except Exception:
+            self.logger.exception("Failed to flush {}".format(filename))
+            return False
+
+    def shard_path(self, directory, key):
+        return os.path.join(directory, "{}.json".format(key))
+
+    def load_shards(self, directory):
+        """Loads every <key>.json file in directory
+
+        Returns a dict keyed by the files' names"""
+        shards = {}
+        if not os.path.isdir(directory):
+            return shards
+        for entry in os.listdir(directory):
+            key, ext = os.path.splitext(entry)
+            if ext != ".json":
+                continue
+            shards[key] = self.load_json(os.path.join(directory, entry))
+        return shards
+
+    def save_shard(self, directory, key, data):
+        """Atomically saves the shard of key in directory"""
+        os.makedirs(directory, exist_ok=True)
+        return self.save_json(self.shard_path(directory, key), data)
+
+    def mark_shard_dirty(self, directory, key, data, *, delay=None):
+        """Schedules the shard of key in directory to be saved
+
+        See mark_dirty"""
+        os.makedirs(directory, exist_ok=True)
+        return self.mark_dirty(self.shard_path(directory, key), data,
+                               delay=delay)
+
+    def delete_shard(self, directory, key):
+        path = self.shard_path(directory, key)
+        self._discard_pending(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def migrate_to_shards(self, filename, directory, *, is_shard=None):
+        """Moves the top-level keys of a JSON file into their own shard
+
+        If is_shard is passed only the keys it returns True for are moved
+        and the rest is saved back to filename. Otherwise filename is
+        renamed to *.bak once every shard has been saved.
+        Returns the number of shards written"""
+        data = self.load_json(filename)
+        moved = 0
+        for key in list(data):
+            if is_shard is not None and not is_shard(key):
+                continue
+            if not self.save_shard(directory, key, data.pop(key)):
+                raise InvalidFileIO("Failed to save the shard {} of {}"
+                                    "".format(key, filename))
+            moved += 1
+        if is_shard is None:
+            os.replace(filename, filename + ".bak")
+        elif moved:
+            self.save_json(filename, data)
+        self.logger.info("Moved {} entries of {} to {}"
+                         "".format(moved, filename, directory))
+        return moved
+
     def load_json(self, filename):
         """Loads json file"""
-        return self._read_json(filename)
+        if self.is_dirty(filename):
+            self.flush(filename)
+        stamp = self._stamp(filename)
+        data = self._read_json(filename)
+        self._stamps[os.path.normpath(filename)] = stamp
+        return data
 
     def is_valid_json(self, filename):
         """Verifies if json file exists / is readable"""
@@ -46,10 +444,13 @@ class DataIO():
             data = json.load(f)
         return data
 
-    def _save_json(self, filename, data):
+    def _save_json(self, filename, data, fsync=False):
         with open(filename, encoding='utf-8', mode="w") as f:
             json.dump(data, f, indent=4,sort_keys=True,
                 separators=(',',' : '))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
         return data
 
     def _legacy_fileio(self, filename, IO, data=None):
@@ -64,6 +465,108 @@ class DataIO():
             raise InvalidFileIO("FileIO was called with invalid"
                 " parameters")
 
+class LazyJSON(MutableMapping):
+    """Dict-like JSON file that is only read on first access
+
+    It can be passed as is to save_json and mark_dirty"""
+
+    def __init__(self, filename):
+        self.path = filename
+        self._data = None
+        dataIO._lazy.append(weakref.ref(self))
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            dataIO.logger.debug("Loading deferred {}".format(self.path))
+            self._data = dataIO.load_json(self.path)
+        elif dataIO.shared and dataIO.has_changed(self.path):
+            dataIO.logger.debug("Reloading {}, changed by another process"
+                                "".format(self.path))
+            self._data = dataIO.load_json(self.path)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class LazyShards(MutableMapping):
+    """Dict-like view of a sharded folder (see load_shards)
+
+    Each key's shard is read the first time it's accessed. Changes are
+    kept in memory: use save_shard / mark_shard_dirty to persist them"""
+
+    def __init__(self, directory):
+        self.path = directory
+        self._shards = {}
+        if os.path.isdir(directory):
+            self._keys = {os.path.splitext(f)[0] for f in os.listdir(directory)
+                          if f.endswith(".json")}
+        else:
+            self._keys = set()
+        dataIO._lazy.append(weakref.ref(self))
+
+    @property
+    def loaded(self):
+        return len(self._shards) == len(self._keys)
+
+    def __getitem__(self, key):
+        path = dataIO.shard_path(self.path, key)
+        try:
+            shard = self._shards[key]
+        except KeyError:
+            if key not in self._keys and not dataIO.shared:
+                raise
+        else:
+            if not (dataIO.shared and dataIO.has_changed(path)):
+                return shard
+        try:
+            shard = dataIO.load_json(path)
+        except FileNotFoundError:
+            raise KeyError(key)
+        self._keys.add(key)
+        self._shards[key] = shard
+        return shard
+
+    def __setitem__(self, key, value):
+        self._keys.add(key)
+        self._shards[key] = value
+
+    def __delitem__(self, key):
+        self._keys.remove(key)
+        self._shards.pop(key, None)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        if key not in self._keys and dataIO.shared:
+            return os.path.isfile(dataIO.shard_path(self.path, key))
+        return key in self._keys
+
+
 def get_value(filename, key):
     with open(filename, encoding='utf-8', mode="r") as f:
         data = json.load(f)
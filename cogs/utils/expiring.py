@@ -0,0 +1,112 @@
+import time
+import heapq
+from collections.abc import MutableMapping, MutableSet
+from .metrics import metrics
+
+
+class ExpiringDict(MutableMapping):
+    """Dict whose keys are removed ttl seconds after being set
+
+    Expired keys are treated as missing right away and purged, oldest
+    first, whenever the dict is written to or its size is asked, so no
+    task or timer is needed. If name is given the number of keys is
+    reported as the red_expiring_entries gauge."""
+
+    def __init__(self, ttl, *, name=None):
+        self.ttl = ttl
+        self.name = name
+        self._data = {}   # key: (deadline, value)
+        self._heap = []   # (deadline, order, key), stale ones are skipped
+        self._order = 0
+
+    def set(self, key, value, ttl=None):
+        """Sets key, expiring in ttl seconds instead of the default"""
+        now = time.monotonic()
+        self._purge(now)
+        deadline = now + (self.ttl if ttl is None else ttl)
+        self._data[key] = (deadline, value)
+        self._order += 1
+        heapq.heappush(self._heap, (deadline, self._order, key))
+        self._report()
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        deadline, value = self._data[key]
+        if deadline <= time.monotonic():
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def __delitem__(self, key):
+        deadline, _ = self._data[key]
+        del self._data[key]
+        if deadline <= time.monotonic():
+            raise KeyError(key)
+
+    def __iter__(self):
+        now = time.monotonic()
+        return iter([k for k, (deadline, _) in self._data.items()
+                     if deadline > now])
+
+    def __len__(self):
+        self._purge(time.monotonic())
+        return len(self._data)
+
+    def expires_in(self, key):
+        """Seconds before key expires, None if it isn't set"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        left = entry[0] - time.monotonic()
+        return left if left > 0 else None
+
+    def _purge(self, now):
+        heap, data = self._heap, self._data
+        purged = False
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            entry = data.get(key)
+            if entry is not None and entry[0] == deadline:
+                del data[key]
+                purged = True
+        if len(heap) > 2 * len(data) + 64:  # Mostly overwritten deadlines
+            self._heap = [e for e in heap
+                          if e[2] in data and data[e[2]][0] == e[0]]
+            heapq.heapify(self._heap)
+        if purged:
+            self._report()
+
+    def _report(self):
+        if self.name is not None:
+            metrics.set("red_expiring_entries", len(self._data),
+                        cache=self.name)
+
+
+class ExpiringSet(MutableSet):
+    """Set whose items are removed ttl seconds after being added"""
+
+    def __init__(self, ttl, *, name=None):
+        self._dict = ExpiringDict(ttl, name=name)
+
+    def add(self, item, ttl=None):
+        self._dict.set(item, None, ttl)
+
+    def discard(self, item):
+        self._dict.pop(item, None)
+
+    def expires_in(self, item):
+        return self._dict.expires_in(item)
+
+    def __contains__(self, item):
+        return item in self._dict
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
@@ -0,0 +1,91 @@
+import json
+import os
+import asyncio
+import logging
+
+
+log = logging.getLogger("red.journal")
+
+
+class Journal:
+    """Append-only log of JSON records, one per line
+
+    Records are written right away but fsynced in groups: at most
+    sync_delay seconds after the first unsynced append.
+    The owner of the journal is supposed to periodically store a full
+    snapshot of its data and then truncate the journal."""
+
+    def __init__(self, path, *, sync_delay=1):
+        self.path = path
+        self.sync_delay = sync_delay
+        self._file = None
+        self._sync_handle = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def replay(self):
+        """Yields the records currently in the journal
+
+        A partially written last record (e.g. after a crash) is
+        ignored. The journal is cut right before the first corrupted
+        record, so new records aren't appended after it"""
+        if not os.path.isfile(self.path):
+            return
+        good = 0  # Offset of the end of the last good record
+        corrupted = False
+        with open(self.path, mode="rb") as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    good += len(line)
+                    continue
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete record")
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    log.warning("Discarding record {} of {} and the "
+                                "following ones: corrupted"
+                                "".format(n, self.path))
+                    corrupted = True
+                    break
+                good += len(line)
+                self._count += 1
+                yield record
+        if corrupted:
+            self.close()
+            os.truncate(self.path, good)
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.path, encoding='utf-8', mode="a")
+        self._file.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self._file.flush()
+        self._count += 1
+        if self.sync_delay <= 0:
+            self.sync()
+        elif self._sync_handle is None:
+            loop = asyncio.get_event_loop()
+            self._sync_handle = loop.call_later(self.sync_delay, self.sync)
+
+    def sync(self):
+        """Forces the appended records to disk"""
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def truncate(self):
+        """Empties the journal. Call only after a snapshot was saved"""
+        self.close()
+        with open(self.path, encoding='utf-8', mode="w") as f:
+            os.fsync(f.fileno())
+        self._count = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
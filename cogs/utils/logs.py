@@ -0,0 +1,94 @@
+import json
+import queue
+import atexit
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener
+from .metrics import metrics
+
+
+FORMATS = ("text", "json")
+log_format = "text"  # Set from the --log-format argument at boot
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as JSON objects, one per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.utcfromtimestamp(
+                record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _Enqueuer(QueueHandler):
+    """Puts the records meant for handler in the pipeline's queue"""
+
+    def __init__(self, pipeline, handler):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self.handler = handler
+        self.setLevel(handler.level)
+
+    def prepare(self, record):
+        # QueueHandler would format the record here, on the caller's
+        # thread, and drop its exc_info. The writer's handler does it all
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((self.handler, record))
+        except queue.Full:
+            self.pipeline.dropped += 1
+            metrics.inc("red_log_dropped_total")
+
+
+class _Writer(QueueListener):
+    def handle(self, item):
+        handler, record = item
+        if record.levelno >= handler.level:
+            handler.handle(record)
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Waits if the queue is full
+
+
+class LogPipeline:
+    """Moves the formatting and writing of log records to a thread
+
+    Handlers attached through the pipeline get their records from a
+    bounded queue. When it's full new records are dropped and counted
+    instead of blocking the caller."""
+
+    def __init__(self, maxsize=10000):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self._writer = None
+
+    def attach(self, logger, handler):
+        """Adds handler to logger, writing from the pipeline's thread"""
+        if log_format == "json" and isinstance(handler, logging.FileHandler):
+            handler.setFormatter(JSONFormatter())
+        logger.addHandler(_Enqueuer(self, handler))
+        if self._writer is None:
+            self._writer = _Writer(self.queue)
+            self._writer.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Writes the queued records and stops the thread"""
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+
+
+pipeline = LogPipeline()
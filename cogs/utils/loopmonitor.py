@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+from collections import deque, namedtuple
+from .metrics import metrics
+
+
+log = logging.getLogger("red.loopmonitor")
+
+# started_at is a time.time() timestamp, duration is in seconds and location
+# the "file:line in function" the loop was stuck in when first noticed
+Stall = namedtuple("Stall", "started_at duration location stack")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+class LoopMonitor:
+    """Watchdog reporting the callbacks that block the event loop
+
+    The loop is expected to run a heartbeat every interval seconds. A
+    thread checks on it and, once it's late by more than threshold seconds,
+    captures the stack of the loop's thread. The stall is logged and kept
+    in stalls as soon as the loop gets to run the heartbeat again."""
+
+    def __init__(self, *, threshold=0.1, interval=0.05, history=100):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen=history)
+        self._loop = None
+        self._loop_thread = None
+        self._last_beat = None
+        self._stack = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, loop):
+        """Starts monitoring loop. Has to be called from the loop's thread"""
+        if self.running:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.perf_counter()
+        self._stop.clear()
+        loop.call_soon(self._beat)
+        self._thread = threading.Thread(target=self._watch,
+                                        name="red-loopmonitor", daemon=True)
+        self._thread.start()
+        log.info("Reporting event loop stalls longer than {:.0f}ms"
+                 "".format(self.threshold * 1000))
+
+    def stop(self):
+        self._stop.set()
+
+    def _beat(self):
+        now = time.perf_counter()
+        lag = now - self._last_beat - self.interval
+        metrics.observe("red_loop_lag_seconds", max(lag, 0))
+        stack = self._stack
+        if stack is not None:
+            self._stack = None
+            if lag > self.threshold:
+                self._report(lag, stack)
+        self._last_beat = now
+        if not self._stop.is_set():
+            self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            late = time.perf_counter() - self._last_beat - self.interval
+            if late > self.threshold and self._stack is None:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._stack = traceback.extract_stack(frame)
+
+    def _report(self, duration, stack):
+        location = self.locate(stack)
+        self.stalls.append(Stall(time.time() - duration, duration, location,
+                                 "".join(traceback.format_list(stack))))
+        metrics.inc("red_loop_stalls_total")
+        log.warning("The event loop was blocked for {:.0f}ms in {}"
+                    "".format(duration * 1000, location))
+
+    @staticmethod
+    def locate(stack):
+        """Returns the innermost frame of stack belonging to Red or its
+        cogs, as file:line in function"""
+        for frame in reversed(stack):
+            path = os.path.abspath(frame.filename)
+            if path.startswith(ROOT) and os.sep + "lib" + os.sep not in path:
+                return "{}:{} in {}".format(os.path.relpath(path, ROOT),
+                                            frame.lineno, frame.name)
+        if stack:
+            frame = stack[-1]
+            return "{}:{} in {}".format(frame.filename, frame.lineno,
+                                        frame.name)
+        return "unknown"
+
+
+monitor = LoopMonitor()
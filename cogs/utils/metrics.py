@@ -0,0 +1,192 @@
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+log = logging.getLogger("red.metrics")
+
+# Upper bounds, in seconds, of the latency histograms' buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10)
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, Prometheus style"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimates the q quantile as the upper bound of its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            seen += n
+            yield bound, seen
+
+
+class Metrics:
+    """Process wide counters, gauges and latency histograms
+
+    Every metric is identified by its name and a set of labels, e.g.
+    metrics.inc("red_api_requests_total", endpoint="/channels/{channel_id}")
+    Safe to use from the I/O threads."""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a gauge, a value that can go up and down"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get_counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        """Returns the sum of the counters of name, whatever their labels"""
+        with self._lock:
+            return sum(v for (cname, _), v in self.counters.items()
+                       if cname == name)
+
+    def top(self, name, n=10):
+        """Returns the n histograms of name with the largest total time as
+        (labels, histogram) pairs"""
+        with self._lock:
+            found = [(dict(labels), h) for (hname, labels), h
+                     in self.histograms.items() if hname == name]
+        found.sort(key=lambda item: item[1].sum, reverse=True)
+        return found[:n]
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items(),
+                                key=lambda item: item[0])
+            declared = set()
+            for (name, labels), value in counters:
+                if name not in declared:
+                    lines.append("# TYPE {} counter".format(name))
+                    declared.add(name)
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+            for (name, labels), value in gauges:
+                if name not in declared:
+                    lines.append("# TYPE {} gauge".format(name))
+                    declared.add(name)
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+            for (name, labels), h in histograms:
+                if name not in declared:
+                    lines.append("# TYPE {} histogram".format(name))
+                    declared.add(name)
+                for bound, seen in h.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{}_bucket{} {}".format(
+                        name, _labels(labels + (("le", le),)), seen))
+                lines.append("{}_sum{} {}".format(name, _labels(labels),
+                                                  h.sum))
+                lines.append("{}_count{} {}".format(name, _labels(labels),
+                                                    h.count))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    async def serve(self, host="127.0.0.1", port=9026):
+        """Starts an HTTP server exposing render() at /metrics
+
+        Returns the asyncio server"""
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass  # Headers are ignored
+                parts = request.decode("latin-1").split()
+                if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+                    status, body = "200 OK", self.render()
+                else:
+                    status, body = "404 Not Found", "Not found\n"
+                body = body.encode("utf-8")
+                writer.write("HTTP/1.0 {}\r\n"
+                             "Content-Type: text/plain; version=0.0.4\r\n"
+                             "Content-Length: {}\r\n\r\n"
+                             "".format(status, len(body)).encode("latin-1"))
+                writer.write(body)
+                await writer.drain()
+            except Exception:
+                log.exception("Error while serving the metrics")
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        log.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+        return server
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+                                       .replace('"', '\\"')
+                                       .replace("\n", "\\n"))
+             for k, v in labels)
+    return "{" + ",".join(pairs) + "}"
+
+
+metrics = Metrics()
@@ -0,0 +1,112 @@
+import os
+import inspect
+import logging
+from .dataIO import dataIO, InvalidFileIO
+
+
+log = logging.getLogger("red.migrations")
+
+schema_path = "data/red/schema.json"
+
+
+class Migrations:
+    """Upgrades data files to their latest format once, at startup
+
+    A migration is a function taking the content of a file and returning
+    its upgraded version (or None if it changed it in place). Every
+    migration of a file has a version number: the versions already applied
+    are recorded in schema.json so each one runs only once per file.
+
+    Files that were never migrated get all of their migrations applied,
+    so they have to leave data already in the new format untouched."""
+
+    def __init__(self, path=schema_path):
+        self.path = path
+        self._migrations = {}
+        self._versions = None
+
+    def register(self, filename, version, func=None):
+        """Registers func as the version-th migration of filename
+
+        Can be used as a decorator"""
+        def decorator(func):
+            key = os.path.normpath(filename)
+            self._migrations.setdefault(key, {})[version] = func
+            return func
+        if func is None:
+            return decorator
+        return decorator(func)
+
+    def version(self, filename):
+        """Returns the schema version of filename, 0 if never migrated"""
+        if self._versions is None or dataIO.has_changed(self.path):
+            self._versions = self._load_versions()
+        return self._versions.get(os.path.normpath(filename), 0)
+
+    def run(self, filename):
+        """Applies the pending migrations of filename
+
+        Returns the number of migrations applied"""
+        pending = self._pending(filename)
+        if not pending:
+            return 0
+        with dataIO.lock(filename):
+            data = dataIO.load_json(filename)
+            for version, func in pending:
+                result = func(data)
+                if result is not None:
+                    data = result
+                log.info("Migrated {} to version {}".format(filename,
+                                                            version))
+            self._save(filename, data, version)
+        return len(pending)
+
+    async def run_async(self, filename):
+        """Like run, for files with migrations that are coroutines
+
+        Useful when upgrading the data requires calling some API"""
+        pending = self._pending(filename)
+        if not pending:
+            return 0
+        data = await dataIO.load_json_async(filename)
+        for version, func in pending:
+            result = func(data)
+            if inspect.isawaitable(result):
+                result = await result
+            if result is not None:
+                data = result
+            log.info("Migrated {} to version {}".format(filename, version))
+        self._save(filename, data, version)
+        return len(pending)
+
+    def _pending(self, filename):
+        if not os.path.isfile(filename):
+            # Created later on, already in the latest format
+            return []
+        key = os.path.normpath(filename)
+        current = self.version(key)
+        migrations = self._migrations.get(key, {})
+        return [(v, migrations[v]) for v in sorted(migrations) if v > current]
+
+    def _save(self, filename, data, version):
+        if not dataIO.save_json(filename, data):
+            raise InvalidFileIO("Failed to save the migrated "
+                                "{}".format(filename))
+        self._set_version(os.path.normpath(filename), version)
+
+    def _load_versions(self):
+        if dataIO.is_valid_json(self.path):
+            return dataIO.load_json(self.path)
+        return {}
+
+    def _set_version(self, key, version):
+        def update(versions):
+            versions[key] = version
+            return versions
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._versions = dataIO.update_json(self.path, update, default={})
+
+
+migrations = Migrations()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+
+
+log = logging.getLogger("red.namehistory")
+
+
+class NameHistory:
+    """Last names of users, and their last nicknames in each server
+
+    Every user has a ring buffer of at most size names per server, usernames
+    being kept under the server "". They're rows of a SQLite database,
+    so nothing is loaded until someone's history is asked for. New names
+    are buffered and written in a single transaction, at most flush_delay
+    seconds later or as soon as batch_size of them are pending."""
+
+    def __init__(self, path, *, size=20, flush_delay=5, batch_size=1000):
+        self.path = path
+        self.size = size
+        self.flush_delay = flush_delay
+        self.batch_size = batch_size
+        self._pending = OrderedDict()  # (user, server): [name, ...]
+        self._count = 0
+        self._flush_handle = None
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS names (seq INTEGER "
+                           "PRIMARY KEY, user_id TEXT NOT NULL, server_id "
+                           "TEXT NOT NULL, name TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS names_owner ON names "
+                           "(user_id, server_id, seq)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS imports (source TEXT "
+                           "PRIMARY KEY)")
+
+    def get(self, user_id, server_id=""):
+        """Returns the user's names, oldest first"""
+        rows = self._conn.execute("SELECT name FROM names WHERE user_id = ? "
+                                  "AND server_id = ? ORDER BY seq DESC "
+                                  "LIMIT ?", (user_id, server_id, self.size))
+        names = [row[0] for row in rows][::-1]
+        for name in self._pending.get((user_id, server_id), ()):
+            if name not in names:
+                names.append(name)
+        return names[-self.size:]
+
+    def add(self, user_id, name, server_id=""):
+        """Appends name to the user's names unless it's already among them.
+        Returns whether it was appended"""
+        if name in self.get(user_id, server_id):
+            return False
+        self._pending.setdefault((user_id, server_id), []).append(name)
+        self._count += 1
+        if self._count >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.flush_delay,
+                                                 self.flush)
+        return True
+
+    def add_many(self, entries, source=None):
+        """Stores (user_id, server_id, names) entries as they are, in a
+        single transaction. Meant for imports: names aren't deduplicated
+
+        If given, source is recorded as imported in the same transaction"""
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for user_id, server_id, names in entries:
+                self._insert(user_id, server_id, names[-self.size:])
+            if source is not None:
+                self._conn.execute("INSERT INTO imports (source) VALUES (?)",
+                                   (source,))
+
+    def imported(self, source):
+        """Returns whether source was passed to add_many"""
+        row = self._conn.execute("SELECT 1 FROM imports WHERE source = ?",
+                                 (source,)).fetchone()
+        return row is not None
+
+    def flush(self):
+        """Writes the pending names"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, OrderedDict()
+        count, self._count = self._count, 0
+        try:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                for (user_id, server_id), names in pending.items():
+                    self._insert(user_id, server_id, names)
+        except sqlite3.Error:
+            log.exception("Failed to save {} names, retrying with the next "
+                          "batch".format(count))
+            for key, names in pending.items():
+                self._pending.setdefault(key, [])[:0] = names
+            self._count += count
+            return
+        log.debug("Saved {} names of {} users".format(count, len(pending)))
+
+    def _insert(self, user_id, server_id, names):
+        self._conn.executemany("INSERT INTO names (user_id, server_id, name) "
+                               "VALUES (?, ?, ?)",
+                               [(user_id, server_id, n) for n in names])
+        # Only the last size rows of the ring buffer are kept
+        self._conn.execute("DELETE FROM names WHERE user_id = ? AND "
+                           "server_id = ? AND seq <= (SELECT seq FROM names "
+                           "WHERE user_id = ? AND server_id = ? ORDER BY seq "
+                           "DESC LIMIT 1 OFFSET ?)",
+                           (user_id, server_id, user_id, server_id,
+                            self.size))
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,141 @@
+import time
+import asyncio
+from collections import deque
+from .metrics import metrics
+
+
+# Lanes of each destination's queue: a message waiting in a higher lane is
+# sent before any message of the lower ones
+PRIORITY_HIGH = 0    # Moderation
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2     # Bulk and fun stuff
+LANE_NAMES = ("high", "normal", "low")
+
+MAX_LENGTH = 2000
+
+
+class Outgoing:
+    __slots__ = ("destination", "content", "kwargs", "coalesce", "future",
+                 "queued_at")
+
+    def __init__(self, destination, content, kwargs, coalesce, future):
+        self.destination = destination
+        self.content = content
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class Destination:
+    __slots__ = ("lanes", "worker")
+
+    def __init__(self):
+        self.lanes = tuple(deque() for _ in LANE_NAMES)
+        self.worker = None
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+
+class Outbox:
+    """Schedules outgoing messages in per-destination queues
+
+    Each destination is drained by its own task, one message at a time, so
+    a channel hitting its rate limit doesn't hold up the others.
+    Consecutive plain text messages sent with coalesce=True to the same
+    destination while it's busy are joined, up to 2000 characters, into a
+    single message. Their senders all get that message back."""
+
+    def __init__(self, send):
+        self._send = send
+        self._destinations = {}
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending
+
+    async def send(self, destination, content=None, *,
+                   priority=PRIORITY_NORMAL, coalesce=False, **kwargs):
+        loop = asyncio.get_event_loop()
+        coalesce = (coalesce and isinstance(content, str) and
+                    not kwargs.get("embed") and not kwargs.get("tts"))
+        item = Outgoing(destination, content, kwargs, coalesce,
+                        loop.create_future())
+        key = getattr(destination, "id", destination)
+        try:
+            queue = self._destinations[key]
+        except KeyError:
+            queue = self._destinations[key] = Destination()
+        queue.lanes[priority].append(item)
+        self._pending += 1
+        metrics.inc("red_outbox_queued_total", lane=LANE_NAMES[priority])
+        metrics.set("red_outbox_pending", self._pending)
+        if queue.worker is None:
+            queue.worker = asyncio.ensure_future(self._drain(key, queue))
+        return await item.future
+
+    async def _drain(self, key, queue):
+        try:
+            while True:
+                priority = self._next_lane(queue)
+                if priority is None:
+                    break
+                batch = self._take(queue.lanes[priority])
+                self._pending -= len(batch)
+                metrics.set("red_outbox_pending", self._pending)
+                await self._deliver(batch, LANE_NAMES[priority])
+        finally:
+            queue.worker = None
+            if not len(queue):
+                del self._destinations[key]
+
+    def _next_lane(self, queue):
+        for priority, lane in enumerate(queue.lanes):
+            while lane and lane[0].future.done():  # Cancelled by the sender
+                lane.popleft()
+                self._pending -= 1
+            if lane:
+                return priority
+        return None
+
+    def _take(self, lane):
+        batch = [lane.popleft()]
+        if not batch[0].coalesce:
+            return batch
+        length = len(batch[0].content)
+        while lane:
+            item = lane[0]
+            if item.future.done():
+                lane.popleft()
+                self._pending -= 1
+                continue
+            if (not item.coalesce or
+                    length + 1 + len(item.content) > MAX_LENGTH):
+                break
+            length += 1 + len(item.content)
+            batch.append(lane.popleft())
+        return batch
+
+    async def _deliver(self, batch, lane_name):
+        first = batch[0]
+        now = time.perf_counter()
+        for item in batch:
+            metrics.observe("red_outbox_wait_seconds", now - item.queued_at,
+                            lane=lane_name)
+        if len(batch) > 1:
+            content = "\n".join(item.content for item in batch)
+            metrics.inc("red_outbox_coalesced_total", len(batch) - 1)
+        else:
+            content = first.content
+        try:
+            message = await self._send(first.destination, content,
+                                       **first.kwargs)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+        else:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_result(message)
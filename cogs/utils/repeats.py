@@ -0,0 +1,101 @@
+import re
+import sys
+import time
+from collections import OrderedDict
+from hashlib import sha1
+
+
+def fingerprint(text):
+    """64 bits hash of text, the same across restarts"""
+    return int.from_bytes(sha1(text.encode("utf-8")).digest()[:8], "big")
+
+
+def simhash(text):
+    """64 bits fingerprint of text's words and pairs of words. Similar texts
+    get fingerprints differing by a few bits"""
+    words = re.findall(r"\w+", text.casefold())
+    features = words + [a + " " + b for a, b in zip(words, words[1:])]
+    if not features:
+        return fingerprint(text)
+    # Each bit is set if it's set in most of the features' fingerprints
+    bits = [format(fingerprint(f), "064b") for f in features]
+    half = len(bits) / 2
+    result = 0
+    for column in zip(*bits):
+        result = result << 1 | (column.count("1") > half)
+    return result
+
+
+def distance(a, b):
+    """Number of bits differing between two fingerprints"""
+    return bin(a ^ b).count("1")
+
+
+class RepeatDetector:
+    """Tells when users send the same message over and over
+
+    Keeps the fingerprints of the last messages of each user of each
+    server, for at most max_users of them: when full the least recently
+    active one is forgotten."""
+
+    def __init__(self, max_users=50000):
+        self.max_users = max_users
+        self._history = OrderedDict()  # (server, user): ((fp, time), ...)
+
+    def __len__(self):
+        return len(self._history)
+
+    def check(self, server_id, user_id, content, *, count=3, seconds=0,
+              max_distance=None):
+        """Records a message and returns whether it's the count-th in a row
+        with the same content
+
+        Messages older than seconds, if set, aren't counted. With
+        max_distance their content can differ as long as their simhash
+        doesn't differ by more than that many bits"""
+        now = time.time()
+        if max_distance is None:
+            fp = fingerprint(content)
+        else:
+            fp = simhash(content)
+        key = (server_id, user_id)
+        history = self._history.get(key, ())
+        if seconds:
+            history = tuple(e for e in history if now - e[1] <= seconds)
+        history = (history + ((fp, now),))[-count:]
+        self._history[key] = history
+        self._history.move_to_end(key)
+        if len(self._history) > self.max_users:
+            self._history.popitem(last=False)
+        if len(history) < count:
+            return False
+        if max_distance is None:
+            return all(f == fp for f, _ in history)
+        return all(distance(f, fp) <= max_distance for f, _ in history)
+
+    def forget_server(self, server_id):
+        for key in [k for k in self._history if k[0] == server_id]:
+            del self._history[key]
+
+    def memory(self):
+        """Estimates the bytes used, user IDs excluded"""
+        size = sys.getsizeof(self._history)
+        for key, history in self._history.items():
+            size += sys.getsizeof(key) + sys.getsizeof(history)
+            for entry in history:
+                size += (sys.getsizeof(entry) + sys.getsizeof(entry[0]) +
+                         sys.getsizeof(entry[1]))
+        return size
+
+    def snapshot(self):
+        """JSON serializable copy of the history, least recent first"""
+        return [[server_id, user_id, [list(e) for e in history]]
+                for (server_id, user_id), history in self._history.items()]
+
+    def restore(self, snapshot):
+        for server_id, user_id, history in snapshot:
+            key = (server_id, user_id)
+            self._history[key] = tuple(tuple(e) for e in history)
+            self._history.move_to_end(key)
+        while len(self._history) > self.max_users:
+            self._history.popitem(last=False)
@@ -1,7 +1,10 @@
-from .dataIO import dataIO
+from .dataIO import dataIO, InvalidFileIO, MODES
+from .migrations import migrations
+from . import storage, logs
 from copy import deepcopy
 import discord
 import os
+import re
 import argparse
 
 
@@ -12,6 +15,7 @@ class Settings:
 
     def __init__(self, path=default_path, parse_args=True):
         self.path = path
+        self.servers_path = os.path.splitext(path)[0]
         self.check_folders()
         self.default_settings = {
             "TOKEN": None,
@@ -24,11 +28,21 @@ class Settings:
                         "PREFIXES": []}
                         }
         self._memory_only = False
+        self._prefix_matchers = {}
+        self._last_prefix_match = (None, None)
+        self._staff_roles = {}
+
+        # The data options apply to the settings files and their migrations
+        args = self.parse_cmd_arguments() if parse_args else None
 
         if not dataIO.is_valid_json(self.path):
             self.bot_settings = deepcopy(self.default_settings)
             self.save_settings()
         else:
+            migrations.register(self.path, 1, _migrate_default_roles)
+            migrations.register(self.path, 2, _migrate_login_type)
+            migrations.register(self.path, 3, self._migrate_servers)
+            migrations.run(self.path)
             current = dataIO.load_json(self.path)
             if current.keys() != self.default_settings.keys():
                 for key in self.default_settings.keys():
@@ -38,16 +52,14 @@ class Settings:
                               " field to red settings.json")
                 dataIO.save_json(self.path, current)
             self.bot_settings = dataIO.load_json(self.path)
+            self.bot_settings.update(dataIO.load_shards(self.servers_path))
 
-        if "default" not in self.bot_settings:
-            self.update_old_settings_v1()
-
-        if "LOGIN_TYPE" in self.bot_settings:
-            self.update_old_settings_v2()
-        if parse_args:
-            self.parse_cmd_arguments()
+        if args is not None:
+            self.apply_cmd_arguments(args)
 
     def parse_cmd_arguments(self):
+        """Parses the command line and applies the options about how data
+        is stored. Returns the arguments for apply_cmd_arguments"""
         parser = argparse.ArgumentParser(description="Red - Discord Bot")
         parser.add_argument("--owner", help="ID of the owner. Only who hosts "
                                             "Red should be owner, this has "
@@ -72,6 +84,11 @@ class Settings:
         parser.add_argument("--no-cogs",
                             action="store_true",
                             help="Starts Red with no cogs loaded, only core")
+        parser.add_argument("--eager-cogs",
+                            action="store_true",
+                            help="Loads every enabled cog at boot instead of "
+                                 "when one of its commands or events is "
+                                 "first used")
         parser.add_argument("--self-bot",
                             action='store_true',
                             help="Specifies if Red should log in as selfbot")
@@ -84,12 +101,74 @@ class Settings:
                             help="Makes Red quit with code 0 just before the "
                                  "login. This is useful for testing the boot "
                                  "process.")
+        parser.add_argument("--save-delay",
+                            type=float,
+                            default=dataIO.save_delay,
+                            help="Seconds to wait before writing changed "
+                                 "data files to disk. Writes issued in the "
+                                 "meantime are coalesced. Defaults to 5")
+        parser.add_argument("--save-mode",
+                            action="append",
+                            default=[],
+                            help="How data files are written: compact, safe "
+                                 "(default) or paranoid. Use path=mode to set "
+                                 "it for a file or folder. Can be multiple.")
+        parser.add_argument("--shared-data",
+                            action="store_true",
+                            help="Use when other Red processes or scripts "
+                                 "write to the same data folder. Files are "
+                                 "locked while being written, reloaded when "
+                                 "changed by others and saved right away")
+        parser.add_argument("--storage",
+                            choices=storage.BACKENDS,
+                            default=storage.backend,
+                            help="Where cogs that support it keep their "
+                                 "data. JSON files are imported into SQLite "
+                                 "the first time. Defaults to json")
+        parser.add_argument("--metrics-port",
+                            type=int,
+                            default=None,
+                            help="Serves command, listener, API and data "
+                                 "metrics in the Prometheus format on "
+                                 "http://127.0.0.1:PORT/metrics")
+        parser.add_argument("--profile-loop",
+                            type=float,
+                            nargs="?",
+                            const=0.1,
+                            default=None,
+                            metavar="SECONDS",
+                            help="Logs the code blocking the event loop for "
+                                 "longer than SECONDS. Defaults to 0.1")
+        parser.add_argument("--log-format",
+                            choices=logs.FORMATS,
+                            default=logs.log_format,
+                            help="Format of the log files: text or json "
+                                 "(one object per line). Defaults to text")
         parser.add_argument("--debug",
                             action="store_true",
                             help="Enables debug mode")
 
         args = parser.parse_args()
 
+        self._memory_only = args.memory_only
+        dataIO.save_delay = args.save_delay
+        for entry in args.save_mode:
+            path, _, mode = entry.rpartition("=")
+            if mode not in MODES:
+                parser.error("invalid save mode: {}".format(mode))
+            if path:
+                dataIO.set_mode(path, mode)
+            else:
+                dataIO.default_mode = mode
+        storage.backend = args.storage
+        logs.log_format = args.log_format
+        if args.shared_data:
+            dataIO.shared = True
+            dataIO.save_delay = 0
+        return args
+
+    def apply_cmd_arguments(self, args):
+        """Applies the remaining command line options to the settings"""
         if args.owner:
             self.owner = args.owner
         if args.prefix:
@@ -101,52 +180,45 @@ class Settings:
 
         self.no_prompt = args.no_prompt
         self.self_bot = args.self_bot
-        self._memory_only = args.memory_only
         self._no_cogs = args.no_cogs
+        self._eager_cogs = args.eager_cogs
         self.debug = args.debug
         self._dry_run = args.dry_run
         self.co_owners = args.co_owner
+        self.metrics_port = args.metrics_port
+        self.profile_loop = args.profile_loop
 
         self.save_settings()
 
     def check_folders(self):
-        folders = ("data", os.path.dirname(self.path), "cogs", "cogs/utils")
+        folders = ("data", os.path.dirname(self.path), self.servers_path,
+                   "cogs", "cogs/utils")
         for folder in folders:
             if not os.path.exists(folder):
                 print("Creating " + folder + " folder...")
                 os.makedirs(folder)
 
-    def save_settings(self):
-        if not self._memory_only:
-            dataIO.save_json(self.path, self.bot_settings)
-
-    def update_old_settings_v1(self):
-        # This converts the old settings format
-        mod = self.bot_settings["MOD_ROLE"]
-        admin = self.bot_settings["ADMIN_ROLE"]
-        del self.bot_settings["MOD_ROLE"]
-        del self.bot_settings["ADMIN_ROLE"]
-        self.bot_settings["default"] = {"MOD_ROLE": mod,
-                                        "ADMIN_ROLE": admin,
-                                        "PREFIXES": []
-                                        }
-        self.save_settings()
+    def save_settings(self, server=None):
+        """Saves the global settings or, if passed, the server's ones
 
-    def update_old_settings_v2(self):
-        # The joys of backwards compatibility
-        settings = self.bot_settings
-        if settings["EMAIL"] == "EmailHere":
-            settings["EMAIL"] = None
-        if settings["PASSWORD"] == "":
-            settings["PASSWORD"] = None
-        if settings["LOGIN_TYPE"] == "token":
-            settings["TOKEN"] = settings["EMAIL"]
-            settings["EMAIL"] = None
-            settings["PASSWORD"] = None
+        Each server's settings are kept in their own file"""
+        if self._memory_only:
+            return
+        if server is not None:
+            sid = getattr(server, "id", server)
+            dataIO.save_shard(self.servers_path, sid, self.bot_settings[sid])
         else:
-            settings["TOKEN"] = None
-        del settings["LOGIN_TYPE"]
-        self.save_settings()
+            data = {k: v for k, v in self.bot_settings.items()
+                    if not str(k).isdigit()}
+            dataIO.save_json(self.path, data)
+
+    def _migrate_servers(self, data):
+        # Servers' settings used to be stored in the main file
+        for key in [k for k in data if str(k).isdigit()]:
+            if not dataIO.save_shard(self.servers_path, key, data[key]):
+                raise InvalidFileIO("Failed to save the settings of server "
+                                    "{}".format(key))
+            del data[key]
 
     @property
     def owner(self):
@@ -200,30 +272,25 @@ class Settings:
     def prefixes(self, value):
         assert isinstance(value, list)
         self.bot_settings["PREFIXES"] = value
+        self._invalidate_prefixes()
 
     @property
     def default_admin(self):
-        if "default" not in self.bot_settings:
-            self.update_old_settings()
         return self.bot_settings["default"].get("ADMIN_ROLE", "")
 
     @default_admin.setter
     def default_admin(self, value):
-        if "default" not in self.bot_settings:
-            self.update_old_settings()
         self.bot_settings["default"]["ADMIN_ROLE"] = value
+        self.invalidate_staff_roles()
 
     @property
     def default_mod(self):
-        if "default" not in self.bot_settings:
-            self.update_old_settings_v1()
         return self.bot_settings["default"].get("MOD_ROLE", "")
 
     @default_mod.setter
     def default_mod(self, value):
-        if "default" not in self.bot_settings:
-            self.update_old_settings_v1()
         self.bot_settings["default"]["MOD_ROLE"] = value
+        self.invalidate_staff_roles()
 
     @property
     def servers(self):
@@ -256,7 +323,8 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["ADMIN_ROLE"] = value
-        self.save_settings()
+        self.invalidate_staff_roles(server)
+        self.save_settings(server)
 
     def get_server_mod(self, server):
         if server is None:
@@ -273,7 +341,30 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["MOD_ROLE"] = value
-        self.save_settings()
+        self.invalidate_staff_roles(server)
+        self.save_settings(server)
+
+    def get_server_staff_roles(self, server):
+        """Returns the IDs of the server's roles named like its admin or
+        mod role
+
+        The result is cached until invalidate_staff_roles is called"""
+        try:
+            return self._staff_roles[server.id]
+        except KeyError:
+            pass
+        names = (self.get_server_admin(server), self.get_server_mod(server))
+        roles = frozenset(r.id for r in server.roles if r.name in names)
+        self._staff_roles[server.id] = roles
+        return roles
+
+    def invalidate_staff_roles(self, server=None):
+        """Has to be called when a server's roles are created, renamed or
+        deleted"""
+        if server is None:
+            self._staff_roles.clear()
+        else:
+            self._staff_roles.pop(getattr(server, "id", server), None)
 
     def get_server_prefixes(self, server):
         if server is None or server.id not in self.bot_settings:
@@ -287,13 +378,73 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["PREFIXES"] = prefixes
-        self.save_settings()
+        self._invalidate_prefixes(server.id)
+        self.save_settings(server)
 
     def get_prefixes(self, server):
         """Returns server's prefixes if set, otherwise global ones"""
         p = self.get_server_prefixes(server)
         return p if p else self.prefixes
 
+    def match_prefix(self, server, content):
+        """Returns the server's prefix content starts with, or None
+
+        Server's prefixes are used if set, otherwise the global ones.
+        If more than one prefix matches the longest one wins"""
+        sid = server.id if server is not None else None
+        key, prefix = self._last_prefix_match
+        if key == (sid, content):  # Same message, different listener
+            return prefix
+        try:
+            matcher = self._prefix_matchers[sid]
+        except KeyError:
+            prefixes = sorted(self.get_prefixes(server), key=len,
+                              reverse=True)
+            if prefixes:
+                matcher = re.compile("|".join(map(re.escape, prefixes)))
+            else:
+                matcher = None
+            self._prefix_matchers[sid] = matcher
+        match = matcher.match(content) if matcher is not None else None
+        prefix = match.group() if match is not None else None
+        self._last_prefix_match = ((sid, content), prefix)
+        return prefix
+
+    def _invalidate_prefixes(self, sid=None):
+        if sid is None:
+            self._prefix_matchers.clear()
+        else:
+            self._prefix_matchers.pop(sid, None)
+        self._last_prefix_match = (None, None)
+
     def add_server(self, sid):
         self.bot_settings[sid] = self.bot_settings["default"].copy()
-        self.save_settings()
+        self._invalidate_prefixes(sid)
+        self.invalidate_staff_roles(sid)
+        self.save_settings(sid)
+
+
+def _migrate_default_roles(data):
+    # This converts the old settings format
+    if "default" in data or "MOD_ROLE" not in data:
+        return
+    data["default"] = {"MOD_ROLE": data.pop("MOD_ROLE"),
+                       "ADMIN_ROLE": data.pop("ADMIN_ROLE"),
+                       "PREFIXES": []}
+
+
+def _migrate_login_type(data):
+    # The joys of backwards compatibility
+    if "LOGIN_TYPE" not in data:
+        return
+    if data["EMAIL"] == "EmailHere":
+        data["EMAIL"] = None
+    if data["PASSWORD"] == "":
+        data["PASSWORD"] = None
+    if data["LOGIN_TYPE"] == "token":
+        data["TOKEN"] = data["EMAIL"]
+        data["EMAIL"] = None
+        data["PASSWORD"] = None
+    else:
+        data["TOKEN"] = None
+    del data["LOGIN_TYPE"]
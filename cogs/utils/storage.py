@@ -0,0 +1,276 @@
+import json
+import os
+import sqlite3
+import logging
+from collections.abc import MutableMapping
+from .dataIO import dataIO, InvalidFileIO
+
+log = logging.getLogger("red.storage")
+
+BACKENDS = ("json", "sqlite")
+backend = "json"  # Set from the --storage argument at boot
+
+# Files read through open_storage, the ones migrate_all imports
+SERVER_KEYED = ("data/alias/aliases.json", "data/customcom/commands.json",
+                "data/mod/filter.json")
+
+
+class StorageConflict(Exception):
+    """Both a JSON file and its database were changed since they were last
+    in sync: switching backends would lose one side's changes"""
+
+
+class Storage(MutableMapping):
+    """Dict-like document store
+
+    Every top-level key (usually a server ID) maps to a JSON serializable
+    document. Assigning a key persists it: after changing a document in
+    place call save(key)"""
+
+    def save(self, key):
+        self[key] = self[key]
+
+    def close(self):
+        pass
+
+
+class JSONStorage(Storage):
+    """Keeps all the documents in a single DataIO managed file"""
+
+    def __init__(self, path):
+        self.path = path
+        if dataIO.is_valid_json(path):
+            self._data = dataIO.load_json(path)
+        else:
+            self._data = {}
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        dataIO.mark_dirty(self.path, self._data)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        dataIO.mark_dirty(self.path, self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def close(self):
+        dataIO.flush(self.path)
+
+
+class SQLiteStorage(Storage):
+    """Keeps every document in its own row of a SQLite table
+
+    Documents are decoded on first access and cached afterwards. The
+    table remembers whether it was changed since it was last in sync
+    with its JSON file (see open_storage)"""
+
+    def __init__(self, path, table="documents"):
+        self.path = path
+        self.table = table
+        self._cache = {}
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY "
+                           "KEY, value TEXT NOT NULL)".format(table))
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT "
+                           "PRIMARY KEY, value TEXT NOT NULL)")
+        self.changed = self.get_meta("changed", False)
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        row = self._conn.execute("SELECT value FROM {} WHERE key = ?"
+                                 "".format(self.table), (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        value = self._cache[key] = json.loads(row[0])
+        return value
+
+    def __setitem__(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO {} (key, value) VALUES "
+                           "(?, ?)".format(self.table),
+                           (key, json.dumps(value)))
+        self._cache[key] = value
+        self._mark_changed()
+
+    def __delitem__(self, key):
+        cur = self._conn.execute("DELETE FROM {} WHERE key = ?"
+                                 "".format(self.table), (key,))
+        self._cache.pop(key, None)
+        if not cur.rowcount:
+            raise KeyError(key)
+        self._mark_changed()
+
+    def __iter__(self):
+        cur = self._conn.execute("SELECT key FROM {}".format(self.table))
+        return (row[0] for row in cur.fetchall())
+
+    def __len__(self):
+        cur = self._conn.execute("SELECT COUNT(*) FROM {}".format(self.table))
+        return cur.fetchone()[0]
+
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+        cur = self._conn.execute("SELECT 1 FROM {} WHERE key = ?"
+                                 "".format(self.table), (key,))
+        return cur.fetchone() is not None
+
+    def get_meta(self, key, default=None):
+        """Returns a value stored about the table, e.g. where its
+        documents were imported from"""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?",
+                                 (self.table + "." + key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES "
+                           "(?, ?)", (self.table + "." + key,
+                                      json.dumps(value)))
+
+    def update_many(self, items):
+        """Stores many documents in a single transaction"""
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for key, value in items:
+                self[key] = value
+
+    def import_json(self, json_path, data):
+        """Replaces every document by those of data, read from json_path,
+        in a single transaction. The table is then in sync with the file"""
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM {}".format(self.table))
+            self._cache.clear()
+            for key, value in data.items():
+                self[key] = value
+            self.mark_synced(json_path)
+
+    def export_json(self, json_path):
+        """Saves every document to json_path. The table is then in sync
+        with the file"""
+        data = {key: self[key] for key in self}
+        if not dataIO.save_json(json_path, data):
+            raise InvalidFileIO("Failed to save {}".format(json_path))
+        self.mark_synced(json_path)
+
+    def mark_synced(self, json_path):
+        self.set_meta("json_mtime", os.path.getmtime(json_path))
+        self.set_meta("changed", False)
+        self.changed = False
+
+    def _mark_changed(self):
+        if not self.changed:
+            self.set_meta("changed", True)
+            self.changed = True
+
+    def close(self):
+        self._conn.close()
+
+
+def open_storage(json_path):
+    """Returns the configured storage for the data of json_path
+
+    With the sqlite backend the documents are kept in a database next to
+    the JSON file, which gets imported the first time. Switching backends
+    carries the changes over: the JSON file is imported again if it was
+    changed with the json backend, the database is exported to it if it
+    was changed with the sqlite one. If both were changed StorageConflict
+    is raised instead"""
+    db_path = os.path.splitext(json_path)[0] + ".db"
+    if backend == "sqlite":
+        new_db = not os.path.isfile(db_path)
+        storage = SQLiteStorage(db_path)
+        if dataIO.is_valid_json(json_path):
+            if new_db:
+                migrate_json(json_path, storage)
+            elif _json_changed(json_path, storage):
+                _check_conflict(json_path, storage)
+                log.info("Importing {}, changed since {} was last in sync "
+                         "with it".format(json_path, db_path))
+                migrate_json(json_path, storage)
+        return storage
+    if os.path.isfile(db_path):
+        storage = SQLiteStorage(db_path)
+        try:
+            if storage.changed:
+                if os.path.isfile(json_path):
+                    _check_conflict(json_path, storage)
+                log.info("Exporting {} to {}, changed since they were last "
+                         "in sync".format(db_path, json_path))
+                storage.export_json(json_path)
+        finally:
+            storage.close()
+    return JSONStorage(json_path)
+
+
+def _json_changed(json_path, storage):
+    return os.path.getmtime(json_path) > storage.get_meta("json_mtime", 0)
+
+
+def _check_conflict(json_path, storage):
+    if storage.changed and _json_changed(json_path, storage):
+        storage.close()
+        raise StorageConflict("{} and {} were both changed since they were "
+                              "last in sync".format(json_path, storage.path))
+
+
+def migrate_json(json_path, storage):
+    """Imports a JSON file keyed at the top level into storage
+
+    Returns the number of documents imported or None if the file is
+    not keyed at the top level"""
+    data = dataIO.load_json(json_path)
+    if not isinstance(data, dict):
+        return None
+    if isinstance(storage, SQLiteStorage):
+        storage.import_json(json_path, data)
+    else:
+        for key, value in data.items():
+            storage[key] = value
+    return len(data)
+
+
+def migrate_all():
+    """Imports the SERVER_KEYED files into SQLite
+
+    Existing databases are left untouched"""
+    for json_path in SERVER_KEYED:
+        db_path = os.path.splitext(json_path)[0] + ".db"
+        if not os.path.isfile(json_path):
+            continue
+        if os.path.isfile(db_path):
+            print("Skipping {}: {} already exists".format(json_path, db_path))
+            continue
+        try:
+            data = dataIO.load_json(json_path)
+        except Exception as e:
+            print("Skipping {}: {}".format(json_path, e))
+            continue
+        if not isinstance(data, dict):
+            print("Skipping {}: not keyed at the top level".format(json_path))
+            continue
+        storage = SQLiteStorage(db_path)
+        storage.import_json(json_path, data)
+        storage.close()
+        print("Imported {} documents from {}".format(len(data), json_path))
+
+
+if __name__ == "__main__":
+    # One-shot migration. Run from Red's folder:
+    # python -m cogs.utils.storage
+    migrate_all()
@@ -0,0 +1,138 @@
+import time
+import unicodedata
+from collections import deque
+
+
+# Look-alike characters of other scripts, and invisible ones, mapped to what
+# they're meant to pass for. Applied after the compatibility decomposition,
+# which already takes care of fullwidth, circled, mathematical letters etc.
+CONFUSABLES = {
+    # Cyrillic
+    "а": "a", "А": "a", "В": "b", "е": "e", "Е": "e", "ё": "e", "Ё": "e",
+    "һ": "h", "Н": "h", "і": "i", "І": "i", "ј": "j", "Ј": "j", "К": "k",
+    "ӏ": "l", "М": "m", "о": "o", "О": "o", "р": "p", "Р": "p", "ԛ": "q",
+    "ѕ": "s", "Ѕ": "s", "с": "c", "С": "c", "Т": "t", "у": "y", "У": "y",
+    "ԝ": "w", "х": "x", "Х": "x", "ԁ": "d",
+    # Greek
+    "α": "a", "Α": "a", "Β": "b", "ε": "e", "Ε": "e", "Η": "h", "ι": "i",
+    "Ι": "i", "Κ": "k", "κ": "k", "Μ": "m", "Ν": "n", "ν": "v", "ο": "o",
+    "Ο": "o", "ρ": "p", "Ρ": "p", "Τ": "t", "τ": "t", "υ": "u", "Υ": "y",
+    "χ": "x", "Χ": "x", "Ζ": "z",
+    # Invisible
+    "\u00ad": "", "\u200b": "", "\u200c": "", "\u200d": "", "\u2060": "",
+    "\ufeff": ""
+}
+
+_folded = {}
+
+
+def fold(char):
+    """Returns what char is matched as when normalizing: casefolded, without
+    accents and with look-alikes replaced. Can be empty or longer than one
+    character"""
+    try:
+        return _folded[char]
+    except KeyError:
+        pass
+    folded = "".join(CONFUSABLES.get(c, c).casefold()
+                     for c in unicodedata.normalize("NFKD", char)
+                     if not unicodedata.combining(c))
+    _folded[char] = folded
+    return folded
+
+
+class WordFilter:
+    """Finds which of many words a text contains in a single pass
+
+    The words are compiled into an Aho-Corasick automaton, so the time
+    taken only depends on the text's length. Matching ignores case. With
+    normalize the words and the text are also compared after fold().
+    With whole_words a word only matches if it's not part of a longer
+    word."""
+
+    def __init__(self, words, *, whole_words=False, normalize=False):
+        start = time.perf_counter()
+        self.words = [w for w in words if w]
+        self.whole_words = whole_words
+        self.normalize = normalize
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]  # (index of the word, its length once folded)
+        for i, word in enumerate(self.words):
+            folded = "".join(self._chars(word))
+            if not folded:
+                continue
+            node = 0
+            for c in folded:
+                child = self._goto[node].get(c)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][c] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = child
+            self._out[node] += ((i, len(folded)),)
+        self._link()
+        self.build_time = time.perf_counter() - start
+
+    def __len__(self):
+        """Number of states of the automaton"""
+        return len(self._goto)
+
+    def _chars(self, text):
+        if self.normalize:
+            return (c for char in text for c in fold(char))
+        return text.lower()
+
+    def _link(self):
+        goto, fail, out = self._goto, self._fail, self._out
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and c not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(c, 0)
+                out[child] += out[fail[child]]
+
+    def search(self, text):
+        """Returns the first word found in text, None if there's none"""
+        if not self.words:
+            return None
+        if self.whole_words:
+            return self._search_words(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for c in self._chars(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]:
+                return self.words[out[node][0][0]]
+        return None
+
+    def _search_words(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        in_word = []  # Whether each character is part of a word
+        pending = []  # Matches waiting for the character after them
+        for c in self._chars(text):
+            is_word = c.isalnum() or c == "_"
+            if pending:
+                if not is_word:
+                    return self.words[pending[0]]
+                pending = []
+            in_word.append(is_word)
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for i, length in out[node]:
+                start = len(in_word) - length
+                if start == 0 or not in_word[start - 1]:
+                    pending.append(i)
+        if pending:
+            return self.words[pending[0]]
+        return None
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import sys
 sys.path.insert(0, "lib")
@@ -7,6 +8,7 @@ import logging.handlers
 import traceback
 import datetime
 import subprocess
+import time
 
 try:
     from discord.ext import commands
@@ -20,8 +22,12 @@ except ImportError:
 
 from cogs.utils.settings import Settings
 from cogs.utils.dataIO import dataIO
+from cogs.utils.metrics import metrics
+from cogs.utils.loopmonitor import monitor
+from cogs.utils.outbox import Outbox, PRIORITY_NORMAL
+from cogs.utils import logs
 from cogs.utils.chat_formatting import inline
-from collections import Counter
+from collections import Counter, OrderedDict, namedtuple
 from io import TextIOWrapper
 
 #
@@ -39,24 +45,90 @@ from io import TextIOWrapper
 
 description = "Red - A multifunction Discord bot by Twentysix"
 
+# Snapshots older than this, in seconds, are discarded instead of restored
+SNAPSHOT_MAX_AGE = 600
+
+AccessList = namedtuple("AccessList", "blacklist whitelist ignored_servers "
+                                      "ignored_channels")
+# A message parsed by Bot.parse_message. invoked is the first word after the
+# prefix and args everything that follows it, leading space included
+ParsedMessage = namedtuple("ParsedMessage", "message prefix invoked args "
+                                            "allowed")
+# A cog extension registered from its manifest but not loaded yet
+LazyCog = namedtuple("LazyCog", "manifest stubs")
+
+
+class CommandStub(commands.Command):
+    """Stands in for a command of a cog that hasn't been loaded yet
+
+    Invoking it loads the cog and invokes the real command instead"""
+
+    def __init__(self, module, name, entry):
+        async def stub(*args):
+            pass
+        super().__init__(name, stub, aliases=entry["aliases"],
+                         help=entry["help"], hidden=entry["hidden"])
+        self.extension = module
+        self._cog_name = entry["cog"]
+
+    @property
+    def cog_name(self):
+        return self._cog_name
+
+    async def invoke(self, ctx):
+        bot = ctx.bot
+        bot.load_lazy_cog(self.extension)
+        await bot.get_cog("Owner").disable_commands()
+        command = bot.commands.get(ctx.invoked_with)
+        if command is None or isinstance(command, CommandStub):
+            return  # The cog failed to load, already logged
+        ctx.command = command
+        await command.invoke(ctx)
+
+
+class GroupStub(commands.GroupMixin, CommandStub):
+    """Stands in for a command group. Its subcommands are stubs too, so
+    that help lists them, but the real group handles them once loaded"""
+
+    def __init__(self, module, name, entry):
+        CommandStub.__init__(self, module, name, entry)
+        self.commands = {}
+        for sub_name, sub_entry in entry["commands"].items():
+            sub = make_stub(module, sub_name, sub_entry)
+            sub.parent = self
+            self.add_command(sub)
+
+
+def make_stub(module, name, entry):
+    if entry.get("commands"):
+        return GroupStub(module, name, entry)
+    return CommandStub(module, name, entry)
+
 
 class Bot(commands.Bot):
     def __init__(self, *args, **kwargs):
 
         def prefix_manager(bot, message):
             """
-            Returns prefixes of the message's server if set.
-            If none are set or if the message's server is None
-            it will return the global prefixes instead.
+            Returns the prefix the message starts with, out of the
+            message's server prefixes if set or the global ones.
+            An empty list is returned if there's no match.
 
             Requires a Bot instance and a Message object to be
             passed as arguments.
             """
-            return bot.settings.get_prefixes(message.server)
+            prefix = bot.settings.match_prefix(message.server,
+                                               message.content)
+            return [prefix] if prefix is not None else []
 
         self.counter = Counter()
         self.uptime = datetime.datetime.utcnow()  # Refreshed before login
         self._message_modifiers = []
+        self._access = None
+        self._routes = {}
+        self.lazy_cogs = {}
+        self._lazy_events = {}
+        self._snapshot = None
         self.settings = Settings()
         self._intro_displayed = False
         self._shutdown_mode = None
@@ -70,26 +142,70 @@ class Bot(commands.Bot):
             if self.settings.self_bot:
                 kwargs['pm_help'] = False
         super().__init__(*args, command_prefix=prefix_manager, **kwargs)
-
-    async def send_message(self, *args, **kwargs):
-        if self._message_modifiers:
-            if "content" in kwargs:
-                pass
-            elif len(args) == 2:
-                args = list(args)
-                kwargs["content"] = args.pop()
-            else:
-                return await super().send_message(*args, **kwargs)
-
-            content = kwargs['content']
+        self.outbox = Outbox(super().send_message)
+        self._count_api_requests()
+
+    def _count_api_requests(self):
+        request = self.http.request
+
+        async def counted_request(route, **kwargs):
+            metrics.inc("red_api_requests_total",
+                        method=getattr(route, "method", ""),
+                        endpoint=getattr(route, "path", str(route)))
+            return await request(route, **kwargs)
+
+        self.http.request = counted_request
+
+    def dispatch(self, event, *args, **kwargs):
+        if event == "ready" and self._snapshot is not None:
+            self.restore_snapshot()
+        if self._lazy_events:
+            for module in tuple(self._lazy_events.get("on_" + event, ())):
+                self.load_lazy_cog(module)
+                self.loop.create_task(
+                    self.get_cog("Owner").disable_commands())
+        # Commands are timed from their 'command' event, dispatched right
+        # before they're invoked, to their completion or error
+        if event == "command":
+            args[1]._red_started = time.perf_counter()
+        elif event in ("command_completion", "command_error"):
+            ctx = args[1]
+            started = getattr(ctx, "_red_started", None)
+            if started is not None and ctx.command is not None:
+                metrics.observe("red_command_seconds",
+                                time.perf_counter() - started,
+                                command=ctx.command.qualified_name)
+        super().dispatch(event, *args, **kwargs)
+
+    async def _run_event(self, event, *args, **kwargs):
+        # Red's own event handlers
+        with metrics.timer("red_listener_seconds", listener="Red." + event):
+            await super()._run_event(event, *args, **kwargs)
+
+    async def _run_extra(self, coro, event_name, *args, **kwargs):
+        # Cogs' listeners
+        name = getattr(coro, "__qualname__", repr(coro))
+        with metrics.timer("red_listener_seconds", listener=name):
+            await super()._run_extra(coro, event_name, *args, **kwargs)
+
+    async def send_message(self, destination, content=None, *,
+                           priority=PRIORITY_NORMAL, coalesce=False,
+                           **kwargs):
+        """Queues the message in the destination's outbox and returns it
+        once sent
+
+        Moderation messages should be sent with priority=PRIORITY_HIGH,
+        bulk ones with PRIORITY_LOW. See Outbox for coalesce"""
+        if self._message_modifiers and content is not None:
             for m in self._message_modifiers:
                 try:
                     content = str(m(content))
                 except:   # Faulty modifiers should not
                     pass  # break send_message
-            kwargs['content'] = content
 
-        return await super().send_message(*args, **kwargs)
+        return await self.outbox.send(destination, content,
+                                      priority=priority, coalesce=coalesce,
+                                      **kwargs)
 
     async def shutdown(self, *, restart=False):
         """Gracefully quits Red with exit code 0
@@ -97,8 +213,73 @@ class Bot(commands.Bot):
         If restart is True, the exit code will be 26 instead
         The launcher automatically restarts Red when that happens"""
         self._shutdown_mode = not restart
+        if restart:
+            self.save_snapshot()
+        await dataIO.join()
+        dataIO.flush()
         await self.logout()
 
+    def save_snapshot(self):
+        """Saves what the cogs return from their __snapshot__ method
+
+        It has to be JSON serializable. The next boot passes it to the
+        cog's __restore__ method once connected, right before on_ready"""
+        snapshots = {}
+        for name, cog in self.cogs.items():
+            snapshot = getattr(cog, "__snapshot__", None)
+            if snapshot is None:
+                continue
+            try:
+                data = snapshot()
+                json.dumps(data)
+            except Exception as e:
+                self.logger.exception("Couldn't take the snapshot of "
+                                      "{}".format(name), exc_info=e)
+            else:
+                snapshots[name] = {"module": type(cog).__module__,
+                                   "data": data}
+        dataIO.save_json("data/red/snapshot.json",
+                         {"time": time.time(), "cogs": snapshots})
+
+    def load_snapshot(self):
+        """Reads the snapshot saved by the last restart, if recent enough.
+        It's restored once the ready event is dispatched"""
+        path = "data/red/snapshot.json"
+        if not os.path.isfile(path):
+            return
+        try:
+            snapshot = dataIO.load_json(path)
+            age = time.time() - snapshot["time"]
+            if not isinstance(snapshot["cogs"], dict):
+                raise ValueError("the cogs of the snapshot aren't an object")
+        except Exception as e:
+            self.logger.exception("Discarded an unreadable snapshot",
+                                  exc_info=e)
+            return
+        finally:
+            # Only read once, so a bad snapshot can't stop Red from booting
+            os.remove(path)
+        if age > SNAPSHOT_MAX_AGE:
+            self.logger.info("Discarded a snapshot taken {:.0f}s ago"
+                             "".format(age))
+        else:
+            self._snapshot = snapshot
+
+    def restore_snapshot(self):
+        snapshot, self._snapshot = self._snapshot, None
+        for name, entry in snapshot["cogs"].items():
+            try:
+                self.load_lazy_cog(entry["module"])
+                restore = getattr(self.get_cog(name), "__restore__", None)
+                if restore is None:
+                    continue
+                restore(entry["data"])
+            except Exception as e:
+                self.logger.exception("Couldn't restore the snapshot of "
+                                      "{}".format(name), exc_info=e)
+        self.logger.info("Restored the state of {} cogs"
+                         "".format(len(snapshot["cogs"])))
+
     def add_message_modifier(self, func):
         """
         Adds a message modifier to the bot
@@ -149,40 +330,183 @@ class Bot(commands.Bot):
         if author == self.user:
             return self.settings.self_bot
 
-        mod_cog = self.get_cog('Mod')
-        global_ignores = self.get_cog('Owner').global_ignores
-
         if self.settings.owner == author.id:
             return True
 
-        if author.id in global_ignores["blacklist"]:
+        access = self._access or self._build_access()
+
+        if author.id in access.blacklist:
             return False
 
-        if global_ignores["whitelist"]:
-            if author.id not in global_ignores["whitelist"]:
+        if access.whitelist:
+            if author.id not in access.whitelist:
                 return False
 
         if not message.channel.is_private:
-            server = message.server
-            names = (self.settings.get_server_admin(
-                server), self.settings.get_server_mod(server))
-            results = map(
-                lambda name: discord.utils.get(author.roles, name=name),
-                names)
-            for r in results:
-                if r is not None:
-                    return True
-
-        if mod_cog is not None:
-            if not message.channel.is_private:
-                if message.server.id in mod_cog.ignore_list["SERVERS"]:
-                    return False
-
-                if message.channel.id in mod_cog.ignore_list["CHANNELS"]:
-                    return False
+            staff = self.settings.get_server_staff_roles(message.server)
+            if staff:
+                for role in author.roles:
+                    if role.id in staff:
+                        return True
+
+            if message.server.id in access.ignored_servers:
+                return False
+
+            if message.channel.id in access.ignored_channels:
+                return False
+
+        return True
+
+    def invalidate_access(self):
+        """Has to be called after changing the global blacklist/whitelist
+        or Mod's ignore list"""
+        self._access = None
 
+    def _build_access(self):
+        owner_cog = self.get_cog('Owner')
+        mod_cog = self.get_cog('Mod')
+        global_ignores = getattr(owner_cog, "global_ignores", {})
+        ignore_list = getattr(mod_cog, "ignore_list", {})
+        self._access = AccessList(
+            blacklist=frozenset(global_ignores.get("blacklist", ())),
+            whitelist=frozenset(global_ignores.get("whitelist", ())),
+            ignored_servers=frozenset(ignore_list.get("SERVERS", ())),
+            ignored_channels=frozenset(ignore_list.get("CHANNELS", ())))
+        return self._access
+
+    def add_cog(self, cog):
+        super().add_cog(cog)
+        self.invalidate_access()
+        self.invalidate_help()
+
+    def remove_cog(self, name):
+        cog = self.get_cog(name)
+        super().remove_cog(name)
+        if cog is not None:
+            for handlers in self._routes.values():
+                handlers[:] = [h for h in handlers
+                               if getattr(h, "__self__", None) is not cog]
+        self.invalidate_access()
+        self.invalidate_help()
+
+    def add_command(self, command):
+        super().add_command(command)
+        self.invalidate_help()
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        self.invalidate_help()
+        return command
+
+    def invalidate_help(self):
+        """Discards the cached help pages. To be called when commands are
+        added, removed, disabled or enabled"""
+        formatter = getattr(self, "formatter", None)  # Unset during init
+        clear_cache = getattr(formatter, "clear_cache", None)
+        if clear_cache is not None:
+            clear_cache()
+
+    def add_lazy_cog(self, module, manifest):
+        """Registers the commands and events of a cog extension, as listed in
+        its manifest, without loading it
+
+        The cog gets loaded the first time one of its commands is invoked or
+        one of the events it listens to is dispatched"""
+        stubs = []
+        for name, entry in manifest["commands"].items():
+            if any(n in self.commands for n in [name] + entry["aliases"]):
+                continue
+            stub = make_stub(module, name, entry)
+            self.add_command(stub)
+            stubs.append(stub)
+        for event in manifest_events(manifest):
+            self._lazy_events.setdefault(event, set()).add(module)
+        self.lazy_cogs[module] = LazyCog(manifest, stubs)
+
+    def discard_lazy_cog(self, module):
+        """Removes the stubs of a cog extension registered by add_lazy_cog"""
+        lazy = self.lazy_cogs.pop(module, None)
+        if lazy is None:
+            return
+        for stub in lazy.stubs:
+            if self.commands.get(stub.name) is stub:
+                self.remove_command(stub.name)
+        for event in manifest_events(lazy.manifest):
+            modules = self._lazy_events.get(event, set())
+            modules.discard(module)
+            if not modules:
+                self._lazy_events.pop(event, None)
+
+    def load_lazy_cog(self, module):
+        """Loads a cog extension registered by add_lazy_cog
+
+        Returns False if it failed to load"""
+        if module not in self.lazy_cogs:
+            return True
+        try:
+            with metrics.timer("red_cog_load_seconds", cog=module):
+                self.get_cog("Owner")._load_cog(module)
+        except Exception as e:
+            self.discard_lazy_cog(module)
+            self.logger.exception("Failed to load {}".format(module),
+                                  exc_info=e)
+            return False
+        self.logger.debug("Loaded {} on first use".format(module))
         return True
 
+    def add_route(self, name, handler, server=None):
+        """Routes to handler the server messages made of a prefix followed
+        by name
+
+        Only the first word of name is matched, case insensitively: handler
+        has to check the rest. A route added with a server only applies to
+        that server. handler is a coroutine function receiving the
+        ParsedMessage. Routes of a cog are removed when it's unloaded"""
+        key = (getattr(server, "id", server), name.split(" ")[0].lower())
+        handlers = self._routes.setdefault(key, [])
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def remove_route(self, name, handler, server=None):
+        key = (getattr(server, "id", server), name.split(" ")[0].lower())
+        handlers = self._routes.get(key, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self._routes.pop(key, None)
+
+    def parse_message(self, message):
+        content = message.content
+        prefix = self.settings.match_prefix(message.server, content)
+        if prefix is None:
+            invoked = args = None
+        else:
+            rest = content[len(prefix):]
+            invoked = rest.split(None, 1)[0] if rest[:1].strip() else ""
+            args = content[len(prefix) + len(invoked):]
+        return ParsedMessage(message, prefix, invoked, args,
+                             self.user_allowed(message))
+
+    async def route_message(self, message):
+        """Runs the command or the routes the message invokes"""
+        parsed = self.parse_message(message)
+        if not parsed.allowed or parsed.prefix is None:
+            return
+        if parsed.invoked in self.commands:
+            await self.process_commands(message)
+            return
+        if message.channel.is_private or not parsed.invoked:
+            return
+        key = parsed.invoked.lower()
+        handlers = (self._routes.get((message.server.id, key), []) +
+                    self._routes.get((None, key), []))
+        for handler in handlers:
+            try:
+                await handler(parsed)
+            except Exception:
+                self.logger.exception("Exception in the route of "
+                                      "'{}'".format(key))
+
     async def pip_install(self, name, *, timeout=None):
         """
         Installs a pip package in the local 'lib' folder in a thread safe
@@ -220,8 +544,38 @@ class Bot(commands.Bot):
 
 
 class Formatter(commands.HelpFormatter):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, cache_size=256, **kwargs):
         super().__init__(*args, **kwargs)
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    def format_help_for(self, context, command_or_bot):
+        """Returns the help pages, rendered again only when the entries the
+        user can see, the prefix or the invoked command (shown in the
+        ending note) differ from a cached rendering"""
+        self.context = context
+        self.command = command_or_bot
+        if self.is_bot() or self.is_cog() or self.has_subcommands():
+            visible = tuple(name for name, _ in self.filter_command_list())
+        else:
+            visible = ()
+        key = (id(command_or_bot), context.prefix, context.invoked_with,
+               visible)
+        try:
+            pages = self._cache[key]
+        except KeyError:
+            metrics.inc("red_help_cache_total", result="miss")
+            pages = super().format_help_for(context, command_or_bot)
+            self._cache[key] = pages
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            metrics.inc("red_help_cache_total", result="hit")
+            self._cache.move_to_end(key)
+        return list(pages)
+
+    def clear_cache(self):
+        self._cache.clear()
 
     def _add_subcommands_to_page(self, max_width, commands):
         for name, command in sorted(commands, key=lambda t: t[0]):
@@ -244,6 +598,7 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     __main__.send_cmd_help = bot.send_cmd_help  # Backwards
     __main__.user_allowed = bot.user_allowed    # compatibility
     __main__.settings = bot.settings            # sucks
+    __main__.set_cog = set_cog
 
     async def get_oauth_url():
         try:
@@ -315,7 +670,8 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
         print("{}: {}".format(prefix_label, " ".join(bot.settings.prefixes)))
         print("Owner: " + str(owner))
         print("{}/{} active cogs with {} commands".format(
-            len(bot.cogs), total_cogs, len(bot.commands)))
+            len(bot.cogs) + len(bot.lazy_cogs), total_cogs,
+            len(bot.commands)))
         print("-----------------")
 
         if bot.settings.token and not bot.settings.self_bot:
@@ -331,6 +687,26 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
 
         await bot.get_cog('Owner').disable_commands()
 
+        # Cogs running background tasks can't wait for their first use
+        for module, lazy in list(bot.lazy_cogs.items()):
+            if lazy.manifest["background"]:
+                bot.load_lazy_cog(module)
+                await asyncio.sleep(0)
+        await bot.get_cog('Owner').disable_commands()
+
+    @bot.event
+    async def on_server_role_create(role):
+        bot.settings.invalidate_staff_roles(role.server)
+
+    @bot.event
+    async def on_server_role_delete(role):
+        bot.settings.invalidate_staff_roles(role.server)
+
+    @bot.event
+    async def on_server_role_update(before, after):
+        if before.name != after.name:
+            bot.settings.invalidate_staff_roles(after.server)
+
     @bot.event
     async def on_resumed():
         bot.counter["session_resumed"] += 1
@@ -342,8 +718,7 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     @bot.event
     async def on_message(message):
         bot.counter["messages_read"] += 1
-        if bot.user_allowed(message):
-            await bot.process_commands(message)
+        await bot.route_message(message)
 
     @bot.event
     async def on_command_error(error, ctx):
@@ -489,8 +864,8 @@ def set_logger(bot):
         maxBytes=10**7, backupCount=5)
     fhandler.setFormatter(red_format)
 
-    logger.addHandler(fhandler)
-    logger.addHandler(stdout_handler)
+    logs.pipeline.attach(logger, fhandler)
+    logs.pipeline.attach(logger, stdout_handler)
 
     dpy_logger = logging.getLogger("discord")
     if bot.settings.debug:
@@ -503,7 +878,7 @@ def set_logger(bot):
         '%(asctime)s %(levelname)s %(module)s %(funcName)s %(lineno)d: '
         '%(message)s',
         datefmt="[%d/%m/%Y %H:%M]"))
-    dpy_logger.addHandler(handler)
+    logs.pipeline.attach(dpy_logger, handler)
 
     return logger
 
@@ -554,6 +929,11 @@ def load_cogs(bot):
             dataIO.save_json("data/red/cogs.json", {})
         return
 
+    try:
+        manifests = dataIO.load_json("data/red/cog_manifests.json")
+    except:
+        manifests = {}
+
     failed = []
     extensions = owner_cog._list_cogs()
 
@@ -566,6 +946,11 @@ def load_cogs(bot):
             continue
         to_load = registry.get(extension, False)
         if to_load:
+            manifest = manifests.get(extension)
+            if (manifest is not None and not bot.settings._eager_cogs and
+                    manifest_is_current(extension, manifest)):
+                bot.add_lazy_cog(extension, manifest)
+                continue
             try:
                 owner_cog._load_cog(extension)
             except Exception as e:
@@ -576,10 +961,37 @@ def load_cogs(bot):
 
     dataIO.save_json("data/red/cogs.json", registry)
 
+    deferred = dataIO.deferred()
+    if deferred:
+        bot.logger.info("Deferred loading of {} data files/folders: {}"
+                        "".format(len(deferred), ", ".join(deferred)))
+
+    if bot.lazy_cogs:
+        bot.logger.info("Loading on first use: {}"
+                        "".format(", ".join(sorted(bot.lazy_cogs))))
+
     if failed:
         print("\nFailed to load: {}\n".format(" ".join(failed)))
 
 
+def manifest_is_current(extension, manifest):
+    """Whether the cog's file is unchanged since its manifest was made"""
+    path = os.path.join(*extension.split(".")) + ".py"
+    try:
+        return os.path.getmtime(path) == manifest["mtime"]
+    except (OSError, KeyError):
+        return False
+
+
+def manifest_events(manifest):
+    """The events that load the cog: those it listens to, and messages if
+    it adds routes, since they can match any message"""
+    events = list(manifest["events"])
+    if manifest.get("routes") and "on_message" not in events:
+        events.append("on_message")
+    return events
+
+
 def main(bot):
     check_folders()
     if not bot.settings.no_prompt:
@@ -591,6 +1003,15 @@ def main(bot):
         bot._shutdown_mode = True
         exit(0)
 
+    bot.load_snapshot()
+
+    if bot.settings.metrics_port:
+        yield from metrics.serve(port=bot.settings.metrics_port)
+
+    if bot.settings.profile_loop:
+        monitor.threshold = bot.settings.profile_loop
+        monitor.start(bot.loop)
+
     print("Logging into Discord...")
     bot.uptime = datetime.datetime.utcnow()
 
@@ -634,6 +1055,7 @@ if __name__ == '__main__':
                              exc_info=e)
         loop.run_until_complete(bot.logout())
     finally:
+        dataIO.flush()
         loop.close()
         if bot._shutdown_mode is True:
             exit(0)